@@ -1,15 +1,36 @@
 # srv/app.py
-import os, uuid
+import os, io, re, uuid, json, shutil, hashlib, zipfile
 from typing import List
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, UploadFile, File, Form, Body, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
-from worker import convert_task, download_task
+from celery import states
+import redis.asyncio as aioredis
+from utils import metrics, cad_pool
+from utils.storage import client, BUCKET
+from worker import (celery, rds, REDIS_URL, URL_EXPIRES_SECS, PRIORITY_BATCH, CHUNK_CONVERTERS,
+                    download_task, submit_convert, submit_chunks, submit_multi, cache_lookup, fetch_lookup, fetch_claim,
+                    cancel_task, fetch_detach, time_limits, queue_for, queue_depth, estimated_wait, QUEUE_LIMITS,
+                    QUEUE_BY_KIND, BATCH_QUEUE, DOWNLOAD_QUEUE, MAINTENANCE_QUEUE, BATCH_CHUNK_FILES, MIN_FREE_MB, disk_free_mb,
+                    start_input_upload, presign_parts, uploaded_parts, complete_input_upload,
+                    abort_input_upload, input_part_size, normalize_target, AUDIO_ENC, CAD_TARGETS,
+                    available_targets)
 
 app = FastAPI(title="Media Convert & Fetch")
 
 SHARED_DIR = os.getenv("SHARED_DIR", "/shared")  # volumen compartido entre api y worker
 
+# --- subida por bloques (memoria acotada) ---
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))  # 1 MiB
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "0"))  # por archivo; 0 = sin límite
+MAX_BATCH_MB  = int(os.getenv("MAX_BATCH_MB", "0"))   # total del batch; 0 = sin límite
+
+# --- estado de tareas ---
+ZIP_CHUNK_BYTES = 1024 * 1024  # lectura de MinIO al construir el ZIP
+MAX_STATUS_IDS   = int(os.getenv("MAX_STATUS_IDS", "2000"))  # ids por consulta bulk / stream
+SSE_KEEPALIVE_SECS = 15
+
 # --- catálogos para clasificar por extensión (mismo criterio que frontend) ---
 IMG_EXT = {"jpg","jpeg","png","webp","avif","bmp","tif","tiff","ico","psd","exr","jp2","heic","heif","gif","svg"}
 VID_EXT = {"mp4","webm","mkv","mov","avi","m4v","mpeg","mpg","ts","3gp","3g2","ogv","flv"}
@@ -22,22 +43,210 @@ def classify_by_name(name: str) -> str:
     if ext in AUD_EXT: return "audio"
     return "unknown"
 
+def _copy_upload(src, dst_path: str, limit: int) -> tuple[int, str]:
+    """Copia src -> dst_path en bloques fijos calculando sha256 al vuelo.
+    Se ejecuta en el threadpool para no bloquear el event loop."""
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with open(dst_path, "wb") as out:
+            while True:
+                chunk = src.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if limit and size > limit:
+                    raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+                h.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        try:
+            os.remove(dst_path)
+        except OSError:
+            pass
+        raise
+    return size, h.hexdigest()
+
+# Límite de cuerpo por ruta de subida (bytes; 0 = sin límite) + margen para las cabeceras
+# multipart. FastAPI lee y vuelca todo el formulario antes de llamar al endpoint, así que
+# se comprueba Content-Length antes; el límite por bloques de _copy_upload sigue de respaldo.
+MULTIPART_OVERHEAD = 1024 * 1024
+BODY_LIMITS = {
+    "/convert": MAX_UPLOAD_MB * 1024 * 1024,
+    "/convert/multi": MAX_UPLOAD_MB * 1024 * 1024,
+    "/api/convert/batch": MAX_BATCH_MB * 1024 * 1024,
+}
+
+@app.middleware("http")
+async def gate_uploads(request: Request, call_next):
+    """Rechaza una subida antes de recibir el cuerpo: tamaño por Content-Length y, si el
+    cliente manda ?kind= (y ?target=, ?files= en batch) en la URL, también tipo, cola
+    llena y falta de espacio. Los campos del formulario solo se conocen cuando ya ha
+    llegado todo: sin esos parámetros los endpoints lo comprueban después."""
+    path = request.url.path
+    if request.method != "POST" or path not in BODY_LIMITS:
+        return await call_next(request)
+    limit = BODY_LIMITS[path]
+    length = request.headers.get("content-length", "")
+    if limit and length.isdigit() and int(length) > limit + MULTIPART_OVERHEAD:
+        detail = "Batch demasiado grande" if path.endswith("/batch") else "Archivo demasiado grande"
+        return JSONResponse(status_code=413, content={"detail": detail}, headers={"Connection": "close"})
+    q = request.query_params
+    kind = q.get("kind")
+    if kind:
+        files = q.get("files", "1")
+        try:
+            check_kind(kind, q.get("target"))
+            if path.endswith("/batch") and files.isdigit():
+                await run_in_threadpool(admit, batch_queue_for(kind), batch_messages(kind, int(files)))
+            else:
+                await run_in_threadpool(admit, queue_for(kind))
+            check_shared_space()
+        except HTTPException as e:
+            return JSONResponse(status_code=e.status_code, content={"detail": e.detail},
+                                headers={**(e.headers or {}), "Connection": "close"})
+    return await call_next(request)
+
+async def save_upload(file: UploadFile, dst_path: str, limit: int = 0) -> tuple[int, str]:
+    """Guarda un UploadFile en disco sin cargarlo entero en RAM. Devuelve (bytes, sha256)."""
+    caps = [x for x in (limit, MAX_UPLOAD_MB * 1024 * 1024) if x]
+    limit = min(caps) if caps else 0
+    await file.seek(0)
+    return await run_in_threadpool(_copy_upload, file.file, dst_path, limit)
+
+def _publish_hit(hit):
+    """Publica un resultado de caché como tarea terminada (sin encolar nada)
+    para que /status responda igual que siempre."""
+    if not hit:
+        return None
+    task_id = uuid.uuid4().hex
+    celery.backend.store_result(task_id, hit, states.SUCCESS)
+    return task_id
+
+# --- admisión: con la cola llena se rechaza sin guardar ni encolar nada (antes de
+# recibir los datos solo si el cliente manda ?kind=, ver gate_uploads) ---
+MAX_RETRY_AFTER_SECS = 3600
+
+def check_kind(kind: str, target: str = None):
+    """400 si el tipo (o el formato de audio, o el destino CAD sin su herramienta) no se
+    puede convertir."""
+    if kind not in QUEUE_BY_KIND:
+        raise HTTPException(status_code=400, detail="kind inválido")
+    if kind == "audio" and target is not None and normalize_target(target) not in AUDIO_ENC:
+        raise HTTPException(status_code=400, detail="Formato de audio no soportado")
+    if kind == "mesh" and target is not None:
+        t = normalize_target(target)
+        tool = CAD_TARGETS.get(t)
+        if tool and not cad_pool.available(tool):
+            raise HTTPException(status_code=400,
+                                detail=f"{t} requiere {tool}, que no está instalado en el servidor")
+
+def batch_queue_for(kind: str) -> str:
+    """Cola a la que va un batch: los tipos por trozos tienen la suya."""
+    return BATCH_QUEUE if kind in CHUNK_CONVERTERS else queue_for(kind)
+
+def batch_messages(kind: str, files: int) -> int:
+    """Mensajes que encolaría un batch de `files` archivos (sin contar aciertos de caché)."""
+    return -(-files // BATCH_CHUNK_FILES) if kind in CHUNK_CONVERTERS else files
+
+def admit(queue: str, n: int = 1):
+    """429 + Retry-After si encolar n mensajes más supera QUEUE_LIMITS[queue]."""
+    limit = QUEUE_LIMITS.get(queue, 0)
+    if not limit:
+        return
+    depth = queue_depth(queue)
+    if depth + n > limit:
+        wait = estimated_wait(queue, depth + n - limit)
+        retry = max(1, min(MAX_RETRY_AFTER_SECS, int(wait)))
+        raise HTTPException(status_code=429, detail=f"Cola {queue} llena ({depth} en espera)",
+                            headers={"Retry-After": str(retry)})
+
+def check_shared_space():
+    """507 si /shared está por debajo del mínimo: la subida llenaría el disco de los encodes."""
+    if MIN_FREE_MB and os.path.isdir(SHARED_DIR) and disk_free_mb(SHARED_DIR) < MIN_FREE_MB:
+        raise HTTPException(status_code=507, detail="Sin espacio temporal, reintenta más tarde",
+                            headers={"Retry-After": "60"})
+
+def cached_task(sha256: str, kind: str, target: str):
+    return _publish_hit(cache_lookup(sha256, kind, target))
+
+def start_fetch(url: str, kind: str, quality: str) -> str:
+    """Caché -> descarga en curso idéntica -> tarea nueva."""
+    task_id = _publish_hit(fetch_lookup(url, kind, quality))
+    if task_id:
+        return task_id
+    admit(DOWNLOAD_QUEUE)
+    task_id = uuid.uuid4().hex
+    running = fetch_claim(url, kind, quality, task_id)
+    if running:
+        return running
+    download_task.apply_async((url, kind, quality), task_id=task_id, **time_limits("download"))
+    return task_id
+
 # ====================== ENDPOINTS ======================
 
 @app.post("/convert")
 async def convert(file: UploadFile = File(...),
                   kind: str = Form(...),
                   target: str = Form(...)):
+    check_kind(kind, target)
+    await run_in_threadpool(admit, queue_for(kind))
+    check_shared_space()
     # carpeta de trabajo dentro de /shared (visible por api y worker)
     jobdir = os.path.join(SHARED_DIR, uuid.uuid4().hex)
     os.makedirs(jobdir, exist_ok=True)
 
     suffix = os.path.splitext(file.filename)[1]
     inpath = os.path.join(jobdir, f"in{suffix}")
-    with open(inpath, "wb") as f:
-        f.write(await file.read())
+    try:
+        with metrics.stage("api_upload", kind, normalize_target(target)):
+            _, sha256 = await save_upload(file, inpath)
+    except HTTPException:
+        shutil.rmtree(jobdir, ignore_errors=True)
+        raise
+
+    task_id = await run_in_threadpool(cached_task, sha256, kind, target)
+    if task_id:
+        shutil.rmtree(jobdir, ignore_errors=True)
+        return {"task_id": task_id, "cached": True}
 
-    task = convert_task.delay(inpath, kind, target)  # ruta absoluta en /shared
+    task = submit_convert(inpath, kind, target, sha256)  # ruta absoluta en /shared
+    return {"task_id": task.id}
+
+def _int_list(raw: str, field: str) -> List[int]:
+    try:
+        return [int(x) for x in raw.split(",") if x.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{field}: lista de enteros separada por comas")
+
+@app.post("/convert/multi")
+async def convert_multi(file: UploadFile = File(...),
+                        kind: str = Form(...),       # "video" | "image"
+                        targets: str = Form(...),    # "mp4,webm"
+                        heights: str = Form(""),     # vídeo: escalera de alturas "1080,720,480"
+                        sizes: str = Form("")):      # imagen: miniaturas "1024,512,256"
+    """Varias salidas de un mismo archivo decodificándolo una sola vez."""
+    if kind not in ("video", "image"):
+        raise HTTPException(status_code=400, detail="kind inválido (usa 'video' o 'image')")
+    target_list = [t.strip() for t in targets.split(",") if t.strip()]
+    if not target_list:
+        raise HTTPException(status_code=400, detail="targets vacío")
+    height_list = _int_list(heights, "heights")
+    size_list = _int_list(sizes, "sizes")
+    await run_in_threadpool(admit, queue_for(kind))
+    check_shared_space()
+
+    jobdir = os.path.join(SHARED_DIR, uuid.uuid4().hex)
+    os.makedirs(jobdir, exist_ok=True)
+    inpath = os.path.join(jobdir, f"in{os.path.splitext(file.filename)[1]}")
+    try:
+        with metrics.stage("api_upload", kind, "multi"):
+            await save_upload(file, inpath)
+    except HTTPException:
+        shutil.rmtree(jobdir, ignore_errors=True)
+        raise
+
+    task = submit_multi(inpath, kind, target_list, height_list or None, size_list or None)
     return {"task_id": task.id}
 
 @app.post("/api/convert/batch")
@@ -45,6 +254,7 @@ async def convert_batch(
     files: List[UploadFile] = File(...),
     kind: str = Form(...),    # "image" | "video" | "audio"
     target: str = Form(...),  # extensión destino (jpg, mp4, etc.)
+    archive: bool = Form(False),  # True -> devuelve archive_url con un único ZIP
 ):
     if not files:
         raise HTTPException(status_code=400, detail="No se recibió ningún archivo")
@@ -54,44 +264,324 @@ async def convert_batch(
     kinds.discard("unknown")
     if len(kinds) != 1 or kind not in kinds:
         raise HTTPException(status_code=400, detail="Todos los archivos deben ser del mismo tipo (imagen / video / audio)")
+    check_kind(kind, target)
+    await run_in_threadpool(admit, batch_queue_for(kind), batch_messages(kind, len(files)))
+    check_shared_space()
 
     # Guardar todos en un jobdir dentro de /shared
     jobdir = os.path.join(SHARED_DIR, uuid.uuid4().hex)
     os.makedirs(jobdir, exist_ok=True)
 
-    tasks = []
-    for f in files:
-        # preserva nombre base
-        inpath = os.path.join(jobdir, os.path.basename(f.filename))
-        # asegura subdirs si vienen con webkitRelativePath
-        os.makedirs(os.path.dirname(inpath), exist_ok=True)
-        with open(inpath, "wb") as w:
-            w.write(await f.read())
-        # lanza una tarea por archivo
-        t = convert_task.delay(inpath, kind, target)
-        tasks.append({"name": os.path.basename(f.filename), "task_id": t.id})
+    # primero se guardan todos (si el batch excede el límite no se encola nada)
+    saved = []
+    batch_left = MAX_BATCH_MB * 1024 * 1024  # 0 = sin límite
+    try:
+        for f in files:
+            # preserva nombre base
+            inpath = os.path.join(jobdir, os.path.basename(f.filename))
+            # asegura subdirs si vienen con webkitRelativePath
+            os.makedirs(os.path.dirname(inpath), exist_ok=True)
+            if MAX_BATCH_MB and batch_left <= 0:
+                raise HTTPException(status_code=413, detail="Batch demasiado grande")
+            with metrics.stage("api_upload", kind, normalize_target(target)):
+                size, sha256 = await save_upload(f, inpath, batch_left if MAX_BATCH_MB else 0)
+            batch_left -= size
+            saved.append((f.filename, inpath, sha256))
+    except HTTPException:
+        shutil.rmtree(jobdir, ignore_errors=True)
+        raise
+
+    # cada entrada: {"task_id", "names"} (+ "name" si es de un solo archivo)
+    tasks, pending = [], []
+    for name, inpath, sha256 in saved:
+        name = os.path.basename(name)
+        task_id = await run_in_threadpool(cached_task, sha256, kind, target)
+        if task_id:
+            os.remove(inpath)
+            tasks.append({"name": name, "names": [name], "task_id": task_id})
+        else:
+            pending.append({"name": name, "path": inpath, "sha256": sha256})
+
+    if kind in CHUNK_CONVERTERS:
+        # tipos ligeros: una tarea por trozo de archivos
+        for task_id, chunk in await run_in_threadpool(submit_chunks, pending, kind, target):
+            tasks.append({"names": [it["name"] for it in chunk], "task_id": task_id})
+    else:
+        for it in pending:
+            # lanza una tarea por archivo
+            task_id = submit_convert(it["path"], kind, target, it["sha256"], priority=PRIORITY_BATCH).id
+            tasks.append({"name": it["name"], "names": [it["name"]], "task_id": task_id})
+
+    # el batch_id agrupa todas las tareas: un único stream (/events?batch=) y /batch/{id}
+    batch_id = uuid.uuid4().hex
+    await run_in_threadpool(rds.set, f"mcd:batch:{batch_id}",
+                            json.dumps({"total": len(saved), "target": normalize_target(target), "tasks": tasks}),
+                            ex=URL_EXPIRES_SECS)
 
     # no borramos jobdir: el worker leerá esos archivos y ya limpia lo suyo
-    return {"tasks": tasks}
+    resp = {"batch_id": batch_id, "tasks": tasks}
+    if archive:
+        resp["archive_url"] = f"/batch/{batch_id}/archive"
+    return resp
+
+# --- subida directa a MinIO (la API no toca los datos) ---
+_UPLOAD_KEY_RE = re.compile(r"^[0-9a-f]{32}/[^/]+$")
+
+def _check_upload_key(key: str):
+    if not _UPLOAD_KEY_RE.match(key or ""):
+        raise HTTPException(status_code=400, detail="key inválida")
+
+@app.post("/uploads")
+def upload_start(filename: str = Body(...), size: int = Body(...), kind: str = Body(None)):
+    """Abre una sesión de subida: URLs PUT firmadas para cada parte."""
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="Tamaño inválido")
+    if MAX_UPLOAD_MB and size > MAX_UPLOAD_MB * 1024 * 1024:
+        raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+    if kind:
+        check_kind(kind)
+        admit(queue_for(kind))  # antes de que el navegador suba nada
+    return start_input_upload(filename, size)
+
+@app.get("/uploads/{upload_id}")
+def upload_resume(upload_id: str, key: str, size: int):
+    """Para reanudar: partes ya subidas + URLs nuevas para las que faltan."""
+    _check_upload_key(key)
+    done = uploaded_parts(key, upload_id)
+    part_size = input_part_size(size)
+    have = {p["part_number"] for p in done}
+    missing = [n for n in range(1, max(1, -(-size // part_size)) + 1) if n not in have]
+    return {"key": key, "upload_id": upload_id, "part_size": part_size,
+            "uploaded": done, "parts": presign_parts(key, upload_id, missing)}
+
+@app.post("/uploads/{upload_id}/complete")
+def upload_complete(upload_id: str,
+                    key: str = Body(...),
+                    parts: List[dict] = Body(...),  # [{"part_number", "etag"}]
+                    kind: str = Body(...),
+                    target: str = Body(...)):
+    """Cierra la subida multipart y encola la conversión leyendo la entrada de MinIO."""
+    _check_upload_key(key)
+    check_kind(kind, target)
+    try:
+        ref = complete_input_upload(key, upload_id, parts, MAX_UPLOAD_MB * 1024 * 1024)
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    task = submit_convert(ref, kind, target)
+    return {"task_id": task.id}
+
+@app.delete("/uploads/{upload_id}")
+def upload_abort(upload_id: str, key: str):
+    _check_upload_key(key)
+    abort_input_upload(key, upload_id)
+    return {"aborted": True}
 
 @app.post("/fetch")
 async def fetch(url: str = Form(...),
                 kind: str = Form(...),      # "video" | "audio"
                 quality: str = Form(...)):  # "best" | "1080p"... o "256k"/"128k"
-    task = download_task.delay(url, kind, quality)
-    return {"task_id": task.id}
+    task_id = await run_in_threadpool(start_fetch, url, kind, quality)
+    return {"task_id": task_id}
 
 @app.get("/status/{task_id}")
 def status(task_id: str):
-    from worker import celery
     a = celery.AsyncResult(task_id)
     if a.successful():
         return JSONResponse({"state": a.state, "result": a.result})
+    if a.state == "PROGRESS":
+        return {"state": a.state, "info": str(a.info), "progress": a.info}
     return {"state": a.state, "info": str(a.info)}
 
+@app.delete("/tasks/{task_id}")
+def cancel(task_id: str):
+    """Cancela una tarea en cola o en marcha (sus subprocesos mueren con ella)."""
+    state = celery.AsyncResult(task_id).state
+    if state in states.READY_STATES:
+        raise HTTPException(status_code=409, detail=f"La tarea ya terminó ({state})")
+    # /fetch comparte la tarea entre peticiones idénticas: solo se cancela con el último
+    left = fetch_detach(task_id)
+    if left > 0:
+        return {"task_id": task_id, "state": state, "detached": True, "waiting": left}
+    cancel_task(task_id)
+    return {"task_id": task_id, "state": states.REVOKED}
+
+# --- estado en bloque y por push (sustituyen al polling por tarea) ---
+def _payload(meta) -> dict:
+    """Mismo formato que /status/{task_id}."""
+    if not meta:
+        return {"state": states.PENDING, "info": "None"}
+    if meta["status"] == states.SUCCESS:
+        return {"state": meta["status"], "result": meta["result"]}
+    if meta["status"] == "PROGRESS":
+        return {"state": meta["status"], "info": str(meta["result"]), "progress": meta["result"]}
+    return {"state": meta["status"], "info": str(meta["result"])}
+
+def bulk_status(task_ids: List[str]) -> dict:
+    """Lee el estado de muchas tareas con un único MGET contra el backend."""
+    be = celery.backend
+    raws = be.mget([be.get_key_for_task(t) for t in task_ids]) if task_ids else []
+    return {t: _payload(be.decode_result(raw) if raw else None) for t, raw in zip(task_ids, raws)}
+
+def _batch_record(batch_id: str) -> dict:
+    raw = rds.get(f"mcd:batch:{batch_id}")
+    if raw is None:
+        raise HTTPException(status_code=404, detail="Batch no encontrado")
+    return json.loads(raw)
+
+def _task_ids(ids: str = "", batch: str = "") -> List[str]:
+    task_ids = [t for t in ids.split(",") if t]
+    if batch:
+        task_ids += [t["task_id"] for t in _batch_record(batch)["tasks"]]
+    if not task_ids:
+        raise HTTPException(status_code=400, detail="Sin tareas")
+    if len(task_ids) > MAX_STATUS_IDS:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_STATUS_IDS} tareas por consulta")
+    return list(dict.fromkeys(task_ids))
+
+@app.post("/status/bulk")
+def status_bulk(ids: List[str] = Body(default=[], embed=True), batch: str = Body(default="", embed=True)):
+    return bulk_status(_task_ids(",".join(ids), batch))
+
+@app.get("/batch/{batch_id}")
+def batch_status(batch_id: str):
+    """Progreso agregado y resultado por archivo de todo el batch."""
+    rec = _batch_record(batch_id)
+    sts = bulk_status([t["task_id"] for t in rec["tasks"]])
+    files, done = [], 0
+    for t in rec["tasks"]:
+        st = sts[t["task_id"]]
+        if st["state"] == states.SUCCESS:
+            res = st["result"]
+            entries = res.get("files") or [{"name": t["names"][0], **res}]
+        elif st["state"] in states.READY_STATES:
+            entries = [{"name": n, "error": st["info"]} for n in t["names"]]
+        else:
+            done += (st.get("progress") or {}).get("done", 0)
+            continue
+        files += entries
+        done += len(entries)
+    total = rec["total"]
+    return {"batch_id": batch_id, "total": total, "done": done,
+            "percent": round(done / total * 100, 1) if total else 100.0,
+            "finished": all(sts[t["task_id"]]["state"] in states.READY_STATES for t in rec["tasks"]),
+            "files": files}
+
+class _ZipSink(io.RawIOBase):
+    """Destino no seekable para zipfile: acumula lo escrito hasta el siguiente drain()."""
+    def __init__(self):
+        self.buf = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buf += b
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = bytes(self.buf)
+        self.buf.clear()
+        return data
+
+def _zip_stream(entries):
+    """ZIP construido al vuelo desde MinIO: nunca se tiene el batch entero en disco
+    ni en memoria (solo un bloque de ZIP_CHUNK_BYTES). Sin compresión: son medios
+    ya comprimidos."""
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for name, key in entries:
+            body = client().get_object(Bucket=BUCKET, Key=key)["Body"]
+            with zf.open(name, "w", force_zip64=True) as entry:
+                for chunk in body.iter_chunks(ZIP_CHUNK_BYTES):
+                    entry.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+@app.get("/batch/{batch_id}/archive")
+def batch_archive(batch_id: str):
+    summary = batch_status(batch_id)
+    if not summary["finished"]:
+        raise HTTPException(status_code=409, detail="El batch aún no ha terminado")
+    target = _batch_record(batch_id).get("target")
+    entries, used = [], set()
+    for f in summary["files"]:
+        if not f.get("key"):
+            continue
+        # nombre del archivo subido, no el del objeto: un acierto de caché apunta a la
+        # salida de otra subida anterior (in.jpg, nombre de otro usuario...)
+        ext = f".{target}" if target else os.path.splitext(f["key"])[1]
+        stem = os.path.splitext(f["name"])[0]
+        name = stem + ext
+        n = 1
+        while name in used:  # nombres repetidos dentro del ZIP
+            name = f"{stem}_{n}{ext}"
+            n += 1
+        used.add(name)
+        entries.append((name, f["key"]))
+    if not entries:
+        raise HTTPException(status_code=404, detail="No hay archivos convertidos")
+    return StreamingResponse(
+        (chunk for chunk in _zip_stream(entries) if chunk),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="batch_{batch_id}.zip"'},
+    )
+
+@app.get("/events")
+async def events(ids: str = "", batch: str = ""):
+    """Server-Sent Events: un evento por cambio de estado de cada tarea.
+    El backend Redis de Celery publica cada escritura de estado en el canal
+    de la propia key, así que basta con suscribirse a esas keys."""
+    task_ids = await run_in_threadpool(_task_ids, ids, batch)
+    prefix = celery.backend.task_keyprefix
+
+    def sse(task_id: str, payload: dict) -> str:
+        return f"data: {json.dumps({'task_id': task_id, **payload}, default=str)}\n\n"
+
+    async def stream():
+        r = aioredis.from_url(REDIS_URL)
+        pubsub = r.pubsub()
+        try:
+            await pubsub.subscribe(*[celery.backend.get_key_for_task(t) for t in task_ids])
+            # foto inicial tras suscribirse: no se pierde ningún cambio entre medias
+            pending = set(task_ids)
+            for t, p in (await run_in_threadpool(bulk_status, task_ids)).items():
+                yield sse(t, p)
+                if p["state"] in states.READY_STATES:
+                    pending.discard(t)
+            while pending:
+                msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=SSE_KEEPALIVE_SECS)
+                if msg is None:
+                    yield ": keepalive\n\n"
+                    continue
+                t = msg["channel"][len(prefix):].decode()
+                p = _payload(celery.backend.decode_result(msg["data"]))
+                yield sse(t, p)
+                if p["state"] in states.READY_STATES:
+                    pending.discard(t)
+        finally:
+            await pubsub.aclose()
+            await r.aclose()
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # estáticos y raíz
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+@app.get("/targets")
+def targets():
+    """Destinos que se pueden pedir ahora mismo por tipo (la web oculta el resto)."""
+    return available_targets()
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus: etapas medidas en la API + profundidad de cada cola."""
+    for q in dict.fromkeys((*QUEUE_BY_KIND.values(), BATCH_QUEUE, DOWNLOAD_QUEUE, MAINTENANCE_QUEUE)):
+        metrics.QUEUE_DEPTH.labels(q).set(queue_depth(q))
+    body, content_type = metrics.exposition()
+    return Response(body, media_type=content_type)
+
 @app.get("/")
 async def root():
     return FileResponse("static/index.html")
@@ -0,0 +1,377 @@
+# srv/bench.py
+# Benchmark reproducible de conversiones: genera un corpus determinista (fuentes de
+# prueba de ffmpeg, imágenes de varios tamaños, audio, mallas procedurales), ejecuta cada
+# par (kind, target) con convert_task, el batch por trozos y utils/media_convert.py,
+# y saca files/s, MB/s, p50/p95 y pico de RSS en JSON para comparar ejecuciones.
+#
+# Redis y MinIO se sustituyen por equivalentes en memoria/disco local, así que solo
+# hacen falta las herramientas de conversión (las mismas que la imagen Docker):
+#   python bench.py --out bench.json                # todo
+#   python bench.py --quick --kinds image,mesh      # corpus pequeño, solo algunos tipos
+import os, sys, json, time, uuid, shutil, hashlib, argparse, platform, resource, subprocess, tempfile
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import numpy as np
+
+from utils import mesh_io, cad_pool
+
+# -------------------- corpus --------------------
+IMAGE_SIZES = {"s": (640, 480), "m": (1920, 1080), "l": (4000, 3000)}
+VIDEO_CLIPS = {"s": (640, 360, 5), "m": (1280, 720, 10)}    # ancho, alto, segundos
+AUDIO_CLIPS = {"s": 5, "l": 120}                            # segundos
+MESH_SEGMENTS = {"s": 64, "l": 720}                         # toro u x v: 2·n² triángulos
+QUICK_SIZES = {"s"}
+
+def _ffmpeg(args: str):
+    subprocess.run(f"ffmpeg -v error -y {args}", shell=True, check=True)
+
+def torus(n: int, R: float = 1.0, r: float = 0.35):
+    """Toro de n x n segmentos: (vértices (n²,3), caras (2n²,3))."""
+    a = np.linspace(0, 2 * np.pi, n, endpoint=False)
+    A, B = np.meshgrid(a, a, indexing="ij")
+    verts = np.stack([(R + r * np.cos(B)) * np.cos(A),
+                      (R + r * np.cos(B)) * np.sin(A),
+                      r * np.sin(B)], axis=-1).reshape(-1, 3).astype(np.float32)
+    i, j = np.meshgrid(np.arange(n), np.arange(n), indexing="ij")
+    i1, j1 = (i + 1) % n, (j + 1) % n
+    q0, q1, q2, q3 = i * n + j, i1 * n + j, i1 * n + j1, i * n + j1
+    faces = np.concatenate([np.stack([q0, q1, q2], -1).reshape(-1, 3),
+                            np.stack([q0, q2, q3], -1).reshape(-1, 3)]).astype(np.int32)
+    return verts, faces
+
+def build_corpus(root: str, kinds: list, quick: bool = False) -> dict:
+    """Genera (o reutiliza) el corpus de `kinds` y devuelve {kind: [rutas]}."""
+    sizes = lambda table, kind: {k: v for k, v in table.items()
+                                 if kind in kinds and (not quick or k in QUICK_SIZES)}
+    corpus = {"image": [], "video": [], "audio": [], "mesh": []}
+    os.makedirs(root, exist_ok=True)
+
+    for name, (w, h) in sizes(IMAGE_SIZES, "image").items():
+        for ext, opts in (("png", ""), ("jpg", "-q:v 3")):
+            p = os.path.join(root, f"img_{name}.{ext}")
+            if not os.path.exists(p):
+                _ffmpeg(f'-f lavfi -i "testsrc2=size={w}x{h}" -frames:v 1 {opts} -fflags +bitexact "{p}"')
+            corpus["image"].append(p)
+
+    for name, (w, h, secs) in sizes(VIDEO_CLIPS, "video").items():
+        p = os.path.join(root, f"vid_{name}.mp4")
+        if not os.path.exists(p):
+            _ffmpeg(f'-f lavfi -i "testsrc2=size={w}x{h}:rate=30:duration={secs}" '
+                    f'-f lavfi -i "sine=frequency=440:sample_rate=48000:duration={secs}" '
+                    f'-c:v libx264 -preset veryfast -crf 23 -pix_fmt yuv420p -threads 1 '
+                    f'-c:a aac -b:a 128k -shortest -fflags +bitexact "{p}"')
+        corpus["video"].append(p)
+
+    for name, secs in sizes(AUDIO_CLIPS, "audio").items():
+        for ext, opts in (("wav", "-c:a pcm_s16le"), ("mp3", "-c:a libmp3lame -q:a 2"),
+                          ("m4a", "-c:a aac -b:a 192k"), ("flac", "-c:a flac")):
+            p = os.path.join(root, f"aud_{name}.{ext}")
+            if not os.path.exists(p):
+                _ffmpeg(f'-f lavfi -i "sine=frequency=440:sample_rate=44100:duration={secs}" '
+                        f'-ac 2 {opts} -fflags +bitexact "{p}"')
+            corpus["audio"].append(p)
+
+    for name, n in sizes(MESH_SEGMENTS, "mesh").items():
+        verts, faces = torus(n)
+        for ext in ("stl", "obj", "ply"):
+            p = os.path.join(root, f"mesh_{name}.{ext}")
+            if not os.path.exists(p):
+                {"stl": mesh_io.write_stl, "obj": mesh_io.write_obj, "ply": mesh_io.write_ply}[ext](p, verts, faces)
+            corpus["mesh"].append(p)
+    return corpus
+
+def manifest(corpus: dict) -> dict:
+    """sha256 de cada archivo: dos ejecuciones solo son comparables con el mismo corpus."""
+    out = {}
+    for paths in corpus.values():
+        for p in paths:
+            h = hashlib.sha256()
+            with open(p, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(chunk)
+            out[os.path.basename(p)] = {"bytes": os.path.getsize(p), "sha256": h.hexdigest()}
+    return out
+
+# -------------------- sustitutos de Redis y MinIO --------------------
+class MemoryRedis:
+    """Lo justo de redis.Redis que usa worker.py, en memoria."""
+
+    def __init__(self):
+        self._d = {}
+
+    def _live(self, k):
+        v = self._d.get(k)
+        if v and v[1] is not None and v[1] <= time.monotonic():
+            del self._d[k]
+            return None
+        return v
+
+    def get(self, k):
+        v = self._live(k)
+        return v[0] if v else None
+
+    def set(self, k, value, ex=None, nx=False):
+        if nx and self._live(k):
+            return None
+        value = value if isinstance(value, bytes) else str(value).encode()
+        self._d[k] = (value, time.monotonic() + ex if ex else None)
+        return True
+
+    def ttl(self, k):
+        v = self._live(k)
+        if not v:
+            return -2
+        return -1 if v[1] is None else int(v[1] - time.monotonic())
+
+    def exists(self, *keys):
+        return sum(1 for k in keys if self._live(k))
+
+    def delete(self, *keys):
+        return sum(1 for k in keys if self._d.pop(k, None))
+
+    def llen(self, k):
+        return 0
+
+    def pipeline(self):
+        return _Pipeline(self)
+
+class _Pipeline:
+    def __init__(self, r):
+        self._r, self._calls = r, []
+
+    def __getattr__(self, name):
+        return lambda *a, **kw: self._calls.append((getattr(self._r, name), a, kw))
+
+    def execute(self):
+        return [fn(*a, **kw) for fn, a, kw in self._calls]
+
+class LocalS3:
+    """MinIO en disco local: los objetos son archivos root/<bucket>/<key>."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, bucket, key, mk=False):
+        p = os.path.join(self.root, bucket, key)
+        if mk:
+            os.makedirs(os.path.dirname(p), exist_ok=True)
+        return p
+
+    def head_bucket(self, Bucket):
+        os.makedirs(os.path.join(self.root, Bucket), exist_ok=True)
+
+    create_bucket = head_bucket
+
+    def upload_file(self, path, bucket, key, Config=None):
+        shutil.copyfile(path, self._path(bucket, key, True))
+
+    def download_file(self, bucket, key, path):
+        shutil.copyfile(self._path(bucket, key), path)
+
+    def delete_object(self, Bucket, Key):
+        try:
+            os.remove(self._path(Bucket, Key))
+        except OSError:
+            pass
+
+    def generate_presigned_url(self, op, Params, ExpiresIn=3600):
+        return "file://" + self._path(Params["Bucket"], Params["Key"])
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {"UploadId": uuid.uuid4().hex}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with open(self._path(Bucket, f"{Key}.{UploadId}.{PartNumber:05d}", True), "wb") as f:
+            f.write(Body)
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        with open(self._path(Bucket, Key, True), "wb") as out:
+            for part in MultipartUpload["Parts"]:
+                part_path = self._path(Bucket, f"{Key}.{UploadId}.{part['PartNumber']:05d}")
+                with open(part_path, "rb") as f:
+                    shutil.copyfileobj(f, out)
+                os.remove(part_path)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        d = os.path.dirname(self._path(Bucket, Key))
+        for f in os.listdir(d) if os.path.isdir(d) else []:
+            if f.startswith(f"{os.path.basename(Key)}.{UploadId}."):
+                os.remove(os.path.join(d, f))
+
+def install_standins(workdir: str):
+    """Importa worker con Celery en modo eager y Redis/MinIO sustituidos."""
+    os.environ["SHARED_DIR"] = os.path.join(workdir, "shared")
+    os.makedirs(os.environ["SHARED_DIR"], exist_ok=True)
+    import worker
+    from utils import storage
+    s3 = LocalS3(os.path.join(workdir, "s3"))
+    storage.client = worker.client = lambda: s3
+    worker.rds = MemoryRedis()
+    worker.cache_lookup = lambda *a, **kw: None  # se mide la conversión, no la caché
+    worker.SEGMENT_MIN_SECS = 0                  # sin chord: no hay otros workers
+    worker.celery.conf.update(task_always_eager=True, broker_url="memory://",
+                              result_backend="cache+memory://")
+    return worker
+
+# -------------------- ejecución --------------------
+def percentile(values: list, p: float) -> float:
+    """Percentil por rango más cercano."""
+    s = sorted(values)
+    return s[max(0, min(len(s) - 1, int(np.ceil(p / 100 * len(s))) - 1))]
+
+def _rss_mb(who) -> float:
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)  # Linux: KiB
+
+def _scratch(src: str, workdir: str) -> str:
+    """Copia de la entrada (las tareas borran su entrada al terminar)."""
+    d = os.path.join(workdir, "shared", uuid.uuid4().hex)
+    os.makedirs(d)
+    return shutil.copy(src, d)
+
+def run_case(case: dict) -> dict:
+    """Un par (engine, kind, target) en un proceso nuevo: el pico de RSS es solo suyo."""
+    workdir = case["workdir"]
+    worker = install_standins(workdir)
+    baseline = _rss_mb(resource.RUSAGE_SELF)
+    engine, kind, t, files, repeat = case["engine"], case["kind"], case["target"], case["files"], case["repeat"]
+    latencies, errors, bytes_in = [], [], 0
+
+    def timed(fn, *args):
+        t0 = time.perf_counter()
+        try:
+            fn(*args)
+        except Exception as e:
+            errors.append(str(e).strip().splitlines()[-1][:300] if str(e).strip() else type(e).__name__)
+        latencies.append(time.perf_counter() - t0)
+
+    def convert_task(path):
+        r = worker.convert_task.apply(args=(path, kind, t))
+        if r.failed():
+            raise r.result
+
+    def media_convert(path):
+        from utils.media_convert import media_convert
+        try:
+            media_convert(path, t)
+        finally:
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        if engine == "batch":
+            items = [{"name": os.path.basename(f), "path": _scratch(f, workdir)} for f in files]
+            bytes_in += sum(os.path.getsize(f) for f in files)
+
+            def chunk():
+                r = worker.convert_chunk_task.apply(args=(items, kind, t)).get()
+                errors.extend(f["error"][:300] for f in r["files"] if "error" in f)
+            timed(chunk)
+            continue
+        for f in files:
+            path = _scratch(f, workdir)
+            bytes_in += os.path.getsize(f)
+            timed(convert_task if engine == "convert_task" else media_convert, path)
+    total = time.perf_counter() - start
+
+    n = len(files) * repeat
+    return {
+        "engine": engine, "kind": kind, "target": t,
+        "files": n, "bytes_in": bytes_in, "seconds": round(total, 3),
+        "files_per_s": round(n / total, 3) if total else None,
+        "mb_per_s": round(bytes_in / total / 1e6, 3) if total else None,
+        "latency_per": "chunk" if engine == "batch" else "file",
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "peak_rss_mb": {"baseline": baseline, "self": _rss_mb(resource.RUSAGE_SELF),
+                        "children": _rss_mb(resource.RUSAGE_CHILDREN)},
+        "errors": len(errors), "first_error": errors[0] if errors else None,
+    }
+
+def cases(corpus: dict, kinds: list, targets: set, engines: set, repeat: int, workdir: str) -> list:
+    import worker  # destinos de las tablas del worker (sin conectar a nada)
+    out = []
+    for kind in kinds:
+        files = corpus.get(kind, [])
+        for t in worker.TARGETS_BY_KIND[kind]:
+            if targets and t not in targets:
+                continue
+            base = {"kind": kind, "target": t, "repeat": repeat, "workdir": workdir}
+            srcs = [f for f in files if not f.endswith("." + t)]  # sin conversiones a sí mismo
+            if "convert_task" in engines:
+                out.append({**base, "engine": "convert_task", "files": srcs or files})
+            if "batch" in engines and kind in ("image", "audio"):
+                out.append({**base, "engine": "batch", "files": srcs or files})
+            if "media_convert" in engines and kind in ("image", "video") and srcs:
+                # escribe junto a la entrada: con la misma extensión se pisaría
+                out.append({**base, "engine": "media_convert", "files": srcs})
+    return out
+
+def tool_versions() -> dict:
+    probes = {"ffmpeg": "ffmpeg -version", "vips": "vips --version", "magick": "magick -version",
+              "convert": "convert -version", "assimp": "assimp version"}
+    out = {}
+    for name, cmd in probes.items():
+        if shutil.which(cmd.split()[0]):
+            r = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+            out[name] = (r.stdout or r.stderr).strip().splitlines()[0] if (r.stdout or r.stderr).strip() else ""
+    return out
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark de conversiones MCD")
+    ap.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "mcd-bench-corpus"),
+                    help="directorio del corpus (se reutiliza)")
+    ap.add_argument("--out", help="archivo JSON de resultados (por defecto stdout)")
+    ap.add_argument("--kinds", default="image,video,audio,mesh")
+    ap.add_argument("--targets", default="", help="lista de formatos destino (vacío = todos)")
+    ap.add_argument("--engines", default="convert_task,batch,media_convert")
+    ap.add_argument("--repeat", type=int, default=1)
+    ap.add_argument("--quick", action="store_true", help="solo los tamaños pequeños")
+    args = ap.parse_args(argv)
+
+    import worker  # tablas de destinos y PRESET_VERSION (sin conectar a nada)
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    kinds = [k for k in args.kinds.split(",") if k in worker.TARGETS_BY_KIND]
+    corpus = build_corpus(args.corpus, kinds, args.quick)
+    workdir = os.path.abspath(os.path.join(args.corpus, ".run"))
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    todo = cases(corpus, kinds, {t for t in args.targets.split(",") if t},
+                 set(args.engines.split(",")), args.repeat, workdir)
+
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for case in todo:
+        cad = worker.CAD_TARGETS.get(case["target"]) if case["kind"] == "mesh" else None
+        if cad and not cad_pool.available(cad):
+            results.append({"engine": case["engine"], "kind": case["kind"], "target": case["target"],
+                            "skipped": f"{cad} no instalado"})
+            continue
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as ex:
+            res = ex.submit(run_case, case).result()
+        results.append(res)
+        print(f"{res['engine']:>13} {res['kind']:>5} -> {res['target']:<5} "
+              f"{res['files_per_s']} files/s  {res['mb_per_s']} MB/s  p95 {res['p95_ms']} ms"
+              + (f"  [{res['errors']} errores]" if res["errors"] else ""), file=sys.stderr)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "started_at": started_at,
+            "preset_version": worker.PRESET_VERSION,
+            "python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "repeat": args.repeat, "quick": args.quick,
+            "tools": tool_versions(), "corpus": manifest(corpus),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+# srv/conftest.py
+# Presencia en srv/: pytest añade este directorio al sys.path (import utils, worker...).
@@ -1,5 +1,7 @@
 # scripts/blender_convert.py
-import bpy, argparse, os, sys
+import bpy, argparse, os, sys, json, traceback
+
+REPLY_MARK = "@@MCD@@ "  # mismo valor que utils/cad_pool.py
 
 def import_any(path):
     ext = os.path.splitext(path)[1].lower()
@@ -30,10 +32,30 @@ def main(inp, outp, target):
         else:
             raise RuntimeError(f"Destino no soportado por Blender: {t}")
 
-if __name__ == "__main__":
+def serve():
+    """Modo persistente: un trabajo JSON por línea en stdin, respuesta marcada en stdout.
+    main() vuelve a read_factory_settings en cada trabajo, así no queda escena previa."""
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            main(job["inp"], job["out"], job["target"])
+            reply = {"ok": True}
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            reply = {"ok": False, "error": str(e)}
+        sys.stdout.write(REPLY_MARK + json.dumps(reply) + "\n")
+        sys.stdout.flush()
+
+if os.environ.get("MCD_CAD_SERVE") == "1":
+    serve()
+elif __name__ == "__main__":
+    # blender -b --python blender_convert.py -- --inp ... --out ... --target ...
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else sys.argv[1:]
     ap = argparse.ArgumentParser()
     ap.add_argument("--inp", required=True)
     ap.add_argument("--out", required=True)
     ap.add_argument("--target", required=True)
-    a = ap.parse_args()
+    a = ap.parse_args(argv)
     main(a.inp, a.out, a.target)
@@ -1,38 +1,61 @@
 # scripts/freecad_convert.py
-import sys, os, argparse
+import sys, os, json, argparse, traceback
 
 # FreeCAD inyecta sus módulos al sys.path al lanzar con FreeCADCmd -c script.py
 import FreeCAD as App
 import Mesh, Part, MeshPart
 
+REPLY_MARK = "@@MCD@@ "  # mismo valor que utils/cad_pool.py
+
 def mesh_to_solid(mesh_obj, tol=0.1):
     # malla -> shape (caro; aproxima)
     shape = Part.Shape()
     shape.makeShapeFromMesh(mesh_obj.Topology, tol)  # tolerancia
-    solid = Part.Solid(shape) if shape.Solids else shape
-    return solid
+    try:
+        return Part.Solid(Part.Shell(shape.Faces))
+    except Exception:
+        return shape
 
 def main(inp, outp, target):
     target = target.lower()
     doc = App.newDocument()
+    try:
+        # Carga malla
+        m = Mesh.Mesh(inp)
 
-    # Carga malla
-    m = Mesh.Mesh(inp)
-
-    # Aproximación a sólido
-    solid = mesh_to_solid(m, tol=0.1)
-
-    if target == "step":
-        Part.export([solid], outp)
-    elif target == "iges":
-        Part.export([solid], outp)
-    else:
-        raise RuntimeError(f"Destino no soportado por FreeCAD: {target}")
+        if target == "3mf":
+            obj = doc.addObject("Mesh::Feature", "Mesh")
+            obj.Mesh = m
+            doc.recompute()
+            Mesh.export([obj], outp)
+        elif target == "step":
+            mesh_to_solid(m, tol=0.1).exportStep(outp)
+        elif target == "iges":
+            mesh_to_solid(m, tol=0.1).exportIges(outp)
+        else:
+            raise RuntimeError(f"Destino no soportado por FreeCAD: {target}")
+    finally:
+        # deja el proceso limpio para el siguiente trabajo
+        App.closeDocument(doc.Name)
 
-    doc.saveCompressed = False
-    App.closeDocument(doc.Name)
+def serve():
+    """Modo persistente: un trabajo JSON por línea en stdin, respuesta marcada en stdout."""
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            main(job["inp"], job["out"], job["target"])
+            reply = {"ok": True}
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            reply = {"ok": False, "error": str(e)}
+        sys.stdout.write(REPLY_MARK + json.dumps(reply) + "\n")
+        sys.stdout.flush()
 
-if __name__ == "__main__":
+if os.environ.get("MCD_CAD_SERVE") == "1":
+    serve()
+elif __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("--inp", required=True)
     ap.add_argument("--out", required=True)
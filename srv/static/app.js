@@ -43,9 +43,13 @@ const MAP = {
     exts: ["mp4","mov","mkv","avi","webm","m4v","mpeg","mpg","ts","3gp","3g2","ogv","flv"],
     targets: ["mp4","webm","mkv","mov","avi","m4v","mpeg","mpg","ts","3gp","3g2","ogv","flv","gif"],
   },
+  audio: {
+    exts: ["mp3","m4a","aac","opus","ogg","wav","flac"],
+    targets: ["mp3","m4a","aac","opus","ogg","wav","flac"],
+  },
   mesh: {
     exts: ["stl","obj","glb","gltf","fbx","ply","3ds","dae","off","x","3mf","plyb"],
-    targets: ["glb","gltf","obj","stl","ply","plyb","fbx","3mf","3ds","dae","x","off"],
+    targets: ["glb","gltf","obj","stl","ply","plyb","fbx","3mf","3ds","dae","x","off","step","iges","blend"],
   },
 };
 
@@ -66,6 +70,122 @@ const detectKindByExt = (ext) => {
   return null;
 };
 
+// Oculta los destinos que el servidor no puede generar (p. ej. CAD sin FreeCAD/Blender)
+fetch("/targets")
+  .then((r) => (r.ok ? r.json() : null))
+  .then((avail) => {
+    if (!avail) return;
+    for (const k of Object.keys(MAP)) {
+      if (avail[k]) MAP[k].targets = MAP[k].targets.filter((t) => avail[k].includes(t));
+    }
+  })
+  .catch(() => {});
+
+// ===== Seguimiento de tareas: SSE (/events) con fallback a /status/bulk =====
+const isDone = (s) => ["SUCCESS", "FAILURE", "REVOKED"].includes(s.state);
+
+// "Estado: PROGRESS · 42% · 3.1x · ETA 1:05"
+const describeState = (s) => {
+  const p = s.progress;
+  if (s.state !== "PROGRESS" || !p) return "Estado: " + s.state;
+  const parts = ["Estado: " + (p.stage || s.state)];
+  if (p.percent != null) parts.push(`${p.percent}%`);
+  if (p.speed) parts.push(p.speed);
+  if (p.eta != null) parts.push(`ETA ${Math.floor(p.eta / 60)}:${String(p.eta % 60).padStart(2, "0")}`);
+  return parts.join(" · ");
+};
+
+function watchTasks({ ids = [], batch = null }, onUpdate) {
+  const pending = new Set(ids);
+  const handle = (s) => {
+    onUpdate(s.task_id, s);
+    if (isDone(s)) pending.delete(s.task_id);
+    return pending.size === 0;
+  };
+
+  // Fallback: una única petición por tick para todas las tareas
+  const poll = () => {
+    const timer = setInterval(async () => {
+      try {
+        const res = await fetch("/status/bulk", {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({ ids: [...pending] }),
+        });
+        const states = await res.json();
+        for (const [task_id, s] of Object.entries(states)) {
+          if (handle({ task_id, ...s })) clearInterval(timer);
+        }
+      } catch {
+        // no rompas la UI si falla un poll
+      }
+    }, 1500);
+  };
+
+  if (typeof EventSource === "undefined") return poll();
+
+  const qs = batch ? `batch=${encodeURIComponent(batch)}` : `ids=${encodeURIComponent(ids.join(","))}`;
+  const es = new EventSource("/events?" + qs);
+  es.onmessage = (e) => {
+    if (handle(JSON.parse(e.data))) es.close();
+  };
+  es.onerror = () => {
+    es.close();
+    if (pending.size) poll();
+  };
+}
+
+// ===== Subida directa a MinIO (multipart con URLs firmadas) =====
+const DIRECT_UPLOAD_MIN = 32 * 1024 * 1024;  // por debajo, formulario clásico a /convert
+const PART_CONCURRENCY = 4;
+
+const postJSON = async (url, body) => {
+  const r = await fetch(url, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(body),
+  });
+  const data = await r.json();
+  if (!r.ok) throw new Error(data.detail || "Error");
+  return data;
+};
+
+async function uploadDirect(file, kind, target, onProgress) {
+  const session = await postJSON("/uploads", { filename: file.name, size: file.size, kind });
+  const queue = [...session.parts];
+  const parts = [];
+  let sent = 0;
+
+  const putPart = async ({ part_number, url }) => {
+    const start = (part_number - 1) * session.part_size;
+    const blob = file.slice(start, start + session.part_size);
+    for (let attempt = 1; ; attempt++) {
+      try {
+        const r = await fetch(url, { method: "PUT", body: blob });
+        if (!r.ok) throw new Error("HTTP " + r.status);
+        parts.push({ part_number, etag: r.headers.get("ETag") });
+        sent += blob.size;
+        if (onProgress) onProgress(sent / file.size);
+        return;
+      } catch (e) {
+        if (attempt >= 3) throw e;
+      }
+    }
+  };
+
+  try {
+    await Promise.all(
+      Array.from({ length: PART_CONCURRENCY }, async () => {
+        while (queue.length) await putPart(queue.shift());
+      })
+    );
+  } catch (e) {
+    fetch(`/uploads/${session.upload_id}?key=${encodeURIComponent(session.key)}`, { method: "DELETE" });
+    throw e;
+  }
+  return postJSON(`/uploads/${session.upload_id}/complete`, { key: session.key, parts, kind, target });
+}
+
 // ===== Referencias DOM (convertidor) =====
 const fileInput   = $("#file");
 const fileBadge   = $("#fileBadge");
@@ -128,22 +248,31 @@ window.startConvert = async function startConvert(kind, target) {
   if (status) status.textContent = "Subiendo archivo…";
   if (download) download.innerHTML = "";
 
-  const fd = new FormData();
-  fd.append("file", f);
-  fd.append("kind", kind);
-  fd.append("target", target);
-
   try {
-    const r = await fetch("/convert", { method: "POST", body: fd });
-    const { task_id } = await r.json();
+    let task_id;
+    if (f.size >= DIRECT_UPLOAD_MIN) {
+      // archivos grandes: directo a MinIO, sin pasar por la API
+      ({ task_id } = await uploadDirect(f, kind, target, (p) => {
+        if (status) status.textContent = `Subiendo archivo… ${Math.round(p * 100)}%`;
+      }));
+    } else {
+      const fd = new FormData();
+      fd.append("file", f);
+      fd.append("kind", kind);
+      fd.append("target", target);
+      // kind/target también en la URL: la API rechaza (cola llena, tipo) antes de recibir el archivo
+      const qs = new URLSearchParams({ kind, target });
+      const r = await fetch(`/convert?${qs}`, { method: "POST", body: fd });
+      const data = await r.json();
+      if (!r.ok) throw new Error(data.detail || "Error");
+      ({ task_id } = data);
+    }
 
     if (status) status.textContent = "Procesando…";
-    const poll = setInterval(async () => {
-      const s = await fetch("/status/" + task_id).then((x) => x.json());
-      if (status) status.textContent = "Estado: " + s.state;
+    watchTasks({ ids: [task_id] }, (_, s) => {
+      if (status) status.textContent = describeState(s);
 
       if (s.state === "SUCCESS") {
-        clearInterval(poll);
         prog?.classList.add("hidden");
         const url = s.result?.download_url;
         if (download)
@@ -152,11 +281,10 @@ window.startConvert = async function startConvert(kind, target) {
             : "Terminado sin URL.";
       }
       if (s.state === "FAILURE") {
-        clearInterval(poll);
         prog?.classList.add("hidden");
         if (status) status.textContent = "Error: " + (s.info || "Fallo");
       }
-    }, 1500);
+    });
   } catch (e) {
     prog?.classList.add("hidden");
     if (status) status.textContent = "Error: " + e.message;
@@ -272,6 +400,7 @@ btnConvertFolder?.addEventListener("click", async () => {
   const fd = new FormData();
   fd.append("kind", kind);
   fd.append("target", target);
+  fd.append("archive", "true");  // el servidor construye el ZIP en streaming
   files.forEach((f) => fd.append("files", f, f.webkitRelativePath || f.name));
 
   // UI
@@ -281,91 +410,81 @@ btnConvertFolder?.addEventListener("click", async () => {
   if (batchProg) { batchProg.classList.remove("hidden"); batchProg.value = 0; batchProg.max = files.length; }
 
   try {
-    const res = await fetch("/api/convert/batch", { method: "POST", body: fd });
+    const qs = new URLSearchParams({ kind, target, files: String(files.length) });
+    const res = await fetch(`/api/convert/batch?${qs}`, { method: "POST", body: fd });
     const data = await res.json();
     if (!res.ok) throw new Error(data.detail || "Error al lanzar el batch");
 
+    // Cada tarea cubre uno o varios archivos (los batch de imagen van por trozos)
     const tasks = data.tasks || [];
+    const total = files.length;
     if (batchLog)
-      batchLog.textContent = "Tareas lanzadas:\n" + tasks.map((t) => `- ${t.name}: ${t.task_id}`).join("\n");
-
-    if (status) status.textContent = "Procesando… (0/" + tasks.length + ")";
+      batchLog.textContent = "Tareas lanzadas:\n" + tasks.map((t) => `- ${t.names.join(", ")}: ${t.task_id}`).join("\n");
 
-    // Mapa id->nombre y set para no duplicar enlaces
-    const nameById = Object.fromEntries(tasks.map(t => [t.task_id, t.name]));
-    const shown = new Set();
+    if (status) status.textContent = "Procesando… (0/" + total + ")";
 
-    // Poll de progreso por número de tareas finalizadas
-    const poll = setInterval(async () => {
-      try {
-        const states = await Promise.all(
-          tasks.map(t =>
-            fetch(`/status/${t.task_id}`).then(r => r.json()).catch(() => ({ state: "FAILURE" }))
-          )
-        );
-        let done = 0;
-
-        states.forEach((s, idx) => {
-          const id = tasks[idx].task_id;
-          if (s.state === "SUCCESS" || s.state === "FAILURE") done++;
-
-          // Cuando una tarea termina con éxito por primera vez → añadimos botón
-        //  if (s.state === "SUCCESS" && !shown.has(id) && s.result?.download_url && batchLinks) {
-        //    shown.add(id);
-        //    const a = document.createElement("a");
-        //    a.href = s.result.download_url;
-        //    a.target = "_blank";
-        //    a.className = "btn btn-xs btn-success";
-        //   a.textContent = "Descargar " + (nameById[id] || ("archivo_" + (idx+1)));
-        //    batchLinks.appendChild(a);
-        //  }
-        });
+    // Archivos terminados y resultado por archivo, por tarea
+    const doneByTask = {};
+    const filesByTask = {};
+    const taskById = Object.fromEntries(tasks.map((t) => [t.task_id, t]));
 
-        if (batchProg) batchProg.value = done;
-        if (status) status.textContent = `Procesando… (${done}/${tasks.length})`;
-
-        if (done >= tasks.length) {
-  clearInterval(poll);
-  if (status) status.textContent = "Completado.";
-
-  // Único botón para descargar todo en ZIP
-  if (batchLinks) {
-    batchLinks.innerHTML = "";
-    const zipBtn = document.createElement("button");
-    zipBtn.className = "btn btn-success mt-2";
-    zipBtn.textContent = "Descargar ZIP";
-    zipBtn.onclick = async () => {
-      if (typeof JSZip === "undefined") {
-        alert("Falta JSZip en el index.html");
-        return;
+    watchTasks({ ids: tasks.map((t) => t.task_id), batch: data.batch_id }, (id, s) => {
+      const t = taskById[id];
+      if (!t) return;
+      if (s.state === "SUCCESS") {
+        filesByTask[id] = s.result?.files || [{ name: t.names[0], ...s.result }];
+        doneByTask[id] = t.names.length;
+      } else if (isDone(s)) {
+        filesByTask[id] = [];
+        doneByTask[id] = t.names.length;
+      } else {
+        doneByTask[id] = s.progress?.done || 0;
       }
-      const zip = new JSZip();
-      // Reconsultamos cada tarea para obtener su URL final
-      for (const t of tasks) {
-        const s2 = await fetch(`/status/${t.task_id}`).then(r => r.json());
-        if (s2.state === "SUCCESS" && s2.result?.download_url) {
-          const res = await fetch(s2.result.download_url);
-          const blob = await res.blob();
-          const base = t.name.replace(/\.[^.]+$/, "");
-          const outName = `${base}.${(target || "").toLowerCase()}`;
-          zip.file(outName, blob);
+      const done = Object.values(doneByTask).reduce((a, b) => a + b, 0);
+
+      if (batchProg) batchProg.value = done;
+      if (status) status.textContent = `Procesando… (${done}/${total})`;
+
+      if (Object.keys(filesByTask).length >= tasks.length) {
+        if (status) status.textContent = "Completado.";
+        const results = Object.values(filesByTask).flat().filter((f) => f.download_url);
+
+        // Único botón para descargar todo en ZIP
+        if (batchLinks) {
+          batchLinks.innerHTML = "";
+          const zipBtn = document.createElement("button");
+          zipBtn.className = "btn btn-success mt-2";
+          zipBtn.textContent = "Descargar ZIP";
+          zipBtn.onclick = async () => {
+            // ZIP en streaming desde el servidor (una sola descarga)
+            if (data.archive_url) {
+              window.location.href = data.archive_url;
+              return;
+            }
+            if (typeof JSZip === "undefined") {
+              alert("Falta JSZip en el index.html");
+              return;
+            }
+            const zip = new JSZip();
+            for (const f of results) {
+              const res = await fetch(f.download_url);
+              const blob = await res.blob();
+              const base = f.name.replace(/\.[^.]+$/, "");
+              const outName = `${base}.${(target || "").toLowerCase()}`;
+              zip.file(outName, blob);
+            }
+            const content = await zip.generateAsync({ type: "blob" });
+            const dl = document.createElement("a");
+            dl.href = URL.createObjectURL(content);
+            dl.download = "carpeta_convertida.zip";
+            document.body.appendChild(dl);
+            dl.click();
+            dl.remove();
+          };
+          batchLinks.appendChild(zipBtn);
         }
       }
-      const content = await zip.generateAsync({ type: "blob" });
-      const dl = document.createElement("a");
-      dl.href = URL.createObjectURL(content);
-      dl.download = "carpeta_convertida.zip";
-      document.body.appendChild(dl);
-      dl.click();
-      dl.remove();
-    };
-    batchLinks.appendChild(zipBtn);
-  }
-}
-      } catch {
-        // no rompas la UI si falla un poll
-      }
-    }, 1500);
+    });
   } catch (e) {
     if (status) status.textContent = "Error: " + e.message;
     if (batchProg) batchProg.classList.add("hidden");
@@ -426,15 +545,15 @@ window.startFetch = async function startFetch() {
 
   try {
     const r = await fetch("/fetch", { method: "POST", body: fd });
-    const { task_id } = await r.json();
+    const data = await r.json();
+    if (!r.ok) throw new Error(data.detail || "Error");
+    const { task_id } = data;
 
     if (status2) status2.textContent = "Descargando…";
-    const poll = setInterval(async () => {
-      const s = await fetch("/status/" + task_id).then((x) => x.json());
-      if (status2) status2.textContent = "Estado: " + s.state;
+    watchTasks({ ids: [task_id] }, (_, s) => {
+      if (status2) status2.textContent = describeState(s);
 
       if (s.state === "SUCCESS") {
-        clearInterval(poll);
         prog2?.classList.add("hidden");
         const u = s.result?.download_url;
         if (download2)
@@ -443,11 +562,10 @@ window.startFetch = async function startFetch() {
             : "Terminado sin URL.";
       }
       if (s.state === "FAILURE") {
-        clearInterval(poll);
         prog2?.classList.add("hidden");
         if (status2) status2.textContent = "Error: " + (s.info || "Fallo");
       }
-    }, 1500);
+    });
   } catch (e) {
     prog2?.classList.add("hidden");
     if (status2) status2.textContent = "Error: " + e.message;
@@ -0,0 +1,75 @@
+# srv/tests/test_mesh_io.py
+# Ida y vuelta de la vía nativa de mallas (utils/mesh_io.py): la geometría leída debe ser
+# la escrita, triángulo a triángulo, en todos los pares de formatos.
+import numpy as np
+import pytest
+
+from utils import mesh_io
+
+def _cube():
+    v = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0],
+                  [0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 1, 1]], dtype=np.float32)
+    f = np.array([[0, 2, 1], [0, 3, 2], [4, 5, 6], [4, 6, 7], [0, 1, 5], [0, 5, 4],
+                  [1, 2, 6], [1, 6, 5], [2, 3, 7], [2, 7, 6], [3, 0, 4], [3, 4, 7]], dtype=np.int32)
+    return v, f
+
+def _triangles(vertices, faces):
+    return np.asarray(vertices, dtype=np.float32)[faces]
+
+def _write(path, ext, v, f):
+    if ext == "stl":
+        mesh_io.write_stl(path, v, f)
+    elif ext == "obj":
+        mesh_io.write_obj(path, v, f)
+    else:
+        mesh_io.write_ply(path, v, f, binary=(ext == "plyb"))
+
+@pytest.mark.parametrize("src", ["stl", "obj", "ply", "plyb"])
+@pytest.mark.parametrize("dst", ["stl", "obj", "ply", "plyb"])
+def test_round_trip(tmp_path, src, dst):
+    v, f = _cube()
+    a = tmp_path / f"a.{'ply' if src == 'plyb' else src}"
+    _write(str(a), src, v, f)
+    b = tmp_path / f"b.{dst}"
+    mesh_io.convert(str(a), str(b), dst)
+    got = mesh_io.READERS["ply" if dst == "plyb" else dst](str(b))
+    np.testing.assert_allclose(_triangles(*got), _triangles(v, f), atol=1e-6)
+
+def test_ascii_stl(tmp_path):
+    v, f = _cube()
+    p = tmp_path / "a.stl"
+    with open(p, "w") as fh:
+        fh.write("solid cube\n")
+        for tri in v[f]:
+            fh.write(" facet normal 0 0 0\n  outer loop\n")
+            fh.writelines(f"   vertex {x:g} {y:g} {z:g}\n" for x, y, z in tri)
+            fh.write("  endloop\n endfacet\n")
+        fh.write("endsolid cube\n")
+    np.testing.assert_allclose(_triangles(*mesh_io.read_stl(str(p))), _triangles(v, f))
+
+def test_ascii_ply_polygons(tmp_path):
+    p = tmp_path / "a.ply"
+    p.write_text("ply\nformat ascii 1.0\nelement vertex 4\nproperty float x\nproperty float y\n"
+                 "property float z\nelement face 1\nproperty list uchar int vertex_indices\n"
+                 "end_header\n0 0 0\n1 0 0\n1 1 0\n0 1 0\n4 0 1 2 3\n")
+    _, faces = mesh_io.read_ply(str(p))
+    assert faces.tolist() == [[0, 1, 2], [0, 2, 3]]
+
+def test_obj_negative_indices_are_relative_to_vertices_so_far(tmp_path):
+    p = tmp_path / "a.obj"
+    p.write_text("v 0 0 0\nv 1 0 0\nv 0 1 0\nf -3 -2 -1\n"
+                 "v 0 0 1\nv 1 0 1\nv 0 1 1\nf -3/1 -2/2/2 -1//3\nf 1 2 3 4\n")
+    _, faces = mesh_io.read_obj(str(p))
+    assert faces.tolist() == [[0, 1, 2], [3, 4, 5], [0, 1, 2], [0, 2, 3]]
+
+def test_obj_mixed_vertex_columns(tmp_path):
+    p = tmp_path / "a.obj"
+    p.write_text("v 0 0 0 1 0 0\nv 1 0 0 1 0 0\nv 0 1 0\nf 1 2 3\n")
+    vertices, _ = mesh_io.read_obj(str(p))
+    assert vertices.tolist() == [[0, 0, 0], [1, 0, 0], [0, 1, 0]]
+
+def test_out_of_range_faces_are_unsupported(tmp_path):
+    p = tmp_path / "a.obj"
+    p.write_text("v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 9\n")
+    with pytest.raises(mesh_io.Unsupported):
+        mesh_io.convert(str(p), str(tmp_path / "b.stl"), "stl")
@@ -0,0 +1,128 @@
+# srv/utils/cad_pool.py
+# Procesos FreeCAD/Blender de larga vida: arrancar el intérprete y sus módulos cuesta
+# segundos, así que cada proceso de worker mantiene uno vivo por herramienta y le pasa
+# trabajos por stdin/stdout (una línea JSON por trabajo). Se reciclan tras N trabajos,
+# si su memoria crece demasiado o si un trabajo falla/excede el tiempo.
+import os, json, time, signal, shutil, selectors, subprocess, threading
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+
+FREECAD_BIN = os.getenv("FREECAD_BIN", "freecadcmd")
+BLENDER_BIN = os.getenv("BLENDER_BIN", "blender")
+CAD_MAX_JOBS   = int(os.getenv("CAD_MAX_JOBS", "50"))       # trabajos antes de reciclar
+CAD_MAX_RSS_MB = int(os.getenv("CAD_MAX_RSS_MB", "1500"))   # memoria residente máxima
+
+# Marca de las respuestas: FreeCAD/Blender escriben su propio ruido por stdout
+REPLY_MARK = "@@MCD@@ "
+
+TOOLS = {
+    "freecad": lambda: [FREECAD_BIN, os.path.join(SCRIPTS_DIR, "freecad_convert.py")],
+    "blender": lambda: [BLENDER_BIN, "-b", "--factory-startup",
+                        "--python", os.path.join(SCRIPTS_DIR, "blender_convert.py")],
+}
+
+def available(tool: str) -> bool:
+    """True si el binario de la herramienta está en el PATH."""
+    return shutil.which(TOOLS[tool]()[0]) is not None
+
+class CadWorker:
+    """Un proceso FreeCAD/Blender en modo servidor (MCD_CAD_SERVE=1)."""
+
+    def __init__(self, tool: str):
+        cmd = TOOLS[tool]()
+        if not shutil.which(cmd[0]):
+            raise RuntimeError(f"{tool} no está instalado ({cmd[0]})")
+        self.tool = tool
+        self.jobs = 0
+        self.proc = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            env={**os.environ, "MCD_CAD_SERVE": "1"}, start_new_session=True,
+        )
+        self._buf = b""  # salida leída aún sin procesar (lectura por fd para poder usar select)
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def rss_mb(self) -> float:
+        try:
+            with open(f"/proc/{self.proc.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return 0.0
+
+    def convert(self, inp: str, out: str, target: str, timeout: float) -> str:
+        """Envía un trabajo y espera su respuesta; devuelve el ruido impreso como log."""
+        self.proc.stdin.write((json.dumps({"inp": inp, "out": out, "target": target}) + "\n").encode())
+        self.proc.stdin.flush()
+        self.jobs += 1
+        noise = []
+        deadline = time.monotonic() + timeout
+        fd = self.proc.stdout.fileno()
+        sel = selectors.DefaultSelector()
+        sel.register(fd, selectors.EVENT_READ)
+        try:
+            while True:
+                nl = self._buf.find(b"\n")
+                if nl < 0:
+                    left = deadline - time.monotonic()
+                    if left <= 0 or not sel.select(left):
+                        raise TimeoutError(f"{self.tool}: sin respuesta en {timeout:.0f}s")
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        raise RuntimeError(f"{self.tool} terminó inesperadamente\n{''.join(noise)}")
+                    self._buf += chunk
+                    continue
+                line = self._buf[:nl + 1].decode(errors="replace")
+                self._buf = self._buf[nl + 1:]
+                if line.startswith(REPLY_MARK):
+                    reply = json.loads(line[len(REPLY_MARK):])
+                    if not reply.get("ok"):
+                        raise RuntimeError(f"{self.tool}: {reply.get('error')}\n{''.join(noise)}")
+                    return "".join(noise)
+                noise.append(line)
+        finally:
+            sel.close()
+
+    def kill(self):
+        """Mata el grupo del proceso (y lo que haya lanzado la herramienta)."""
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        self.proc.wait()
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except Exception:
+            self.kill()
+
+_workers = {}
+_lock = threading.Lock()
+
+def convert(tool: str, inp: str, out: str, target: str, timeout: float) -> str:
+    """Convierte con el proceso persistente de `tool` (se crea o recicla si hace falta)."""
+    with _lock:
+        w = _workers.get(tool)
+        if w and (not w.alive() or w.jobs >= CAD_MAX_JOBS or w.rss_mb() > CAD_MAX_RSS_MB):
+            w.close()
+            w = None
+        if w is None:
+            w = _workers[tool] = CadWorker(tool)
+        try:
+            return w.convert(inp, out, target, timeout)
+        except BaseException:
+            # estado desconocido (timeout, crash, cancelación, error a medias): no se reutiliza
+            w.kill()
+            _workers.pop(tool, None)
+            raise
+
+def shutdown():
+    with _lock:
+        for w in _workers.values():
+            w.close()
+        _workers.clear()
@@ -0,0 +1,266 @@
+# srv/utils/mesh_io.py
+# Lectura/escritura nativa (NumPy) de STL, PLY y OBJ para conversiones solo de geometría.
+# Entrada binaria mapeada en memoria, texto leído por bloques acotados y deduplicado de
+# vértices vectorizado; lo que no encaja (propiedades raras, texturas, otros formatos)
+# lanza Unsupported -> assimp.
+import os, re, warnings
+from itertools import islice
+import numpy as np
+
+READ_EXTS  = {"stl", "ply", "obj"}
+WRITE_EXTS = {"stl", "ply", "plyb", "obj"}
+
+class Unsupported(ValueError):
+    """El archivo no se puede tratar por la vía nativa (usar assimp)."""
+
+def supports(src_ext: str, dst_ext: str) -> bool:
+    return src_ext.lower() in READ_EXTS and dst_ext.lower() in WRITE_EXTS
+
+# Bytes de texto por bloque: acota la memoria de los formatos ASCII a algo más que la
+# salida (sin copiar el archivo entero ni un objeto Python por número)
+ASCII_BLOCK_BYTES = 8 * 1024 * 1024
+ASCII_BLOCK_LINES = 100_000
+
+# -------------------- utilidades --------------------
+def _numbers(lines: list, dtype) -> np.ndarray:
+    """Números de varias líneas de texto -> array 1D (sin pasar por objetos Python)."""
+    if not lines:
+        return np.empty(0, dtype=dtype)
+    with warnings.catch_warnings():
+        # fromstring se para en el primer token no numérico y solo lo avisa
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            return np.fromstring(b" ".join(lines), dtype=dtype, sep=" ")
+        except (DeprecationWarning, ValueError):
+            raise Unsupported("número no válido en texto")
+
+def dedup(soup: np.ndarray):
+    """Triángulos sueltos (M,3,3) -> (vértices únicos (N,3), caras (M,3))."""
+    flat = np.ascontiguousarray(soup.reshape(-1, 3), dtype="<f4") + np.float32(0)  # -0.0 -> 0.0
+    keys = flat.view(np.dtype((np.void, 12))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return flat[first], inverse.reshape(-1, 3).astype(np.int32)
+
+def _fan(polys):
+    """Polígonos (listas de índices) -> triángulos en abanico."""
+    tris = [(p[0], p[i], p[i + 1]) for p in polys for i in range(1, len(p) - 1)]
+    return np.array(tris, dtype=np.int32).reshape(-1, 3)
+
+# -------------------- STL --------------------
+_STL_REC = np.dtype([("normal", "<f4", (3,)), ("v", "<f4", (3, 3)), ("attr", "<u2")])
+
+def read_stl(path: str):
+    size = os.path.getsize(path)
+    if size >= 84:
+        with open(path, "rb") as f:
+            f.seek(80)
+            n = int(np.frombuffer(f.read(4), "<u4")[0])
+        if n and size == 84 + n * _STL_REC.itemsize:
+            recs = np.memmap(path, dtype=_STL_REC, mode="r", offset=84, shape=(n,))
+            return dedup(recs["v"])
+    parts = []
+    with open(path, "rb") as f:
+        while True:
+            block = f.readlines(ASCII_BLOCK_BYTES)
+            if not block:
+                break
+            vl = [l.split(None, 1)[1] for l in block if l.lstrip().startswith(b"vertex ")]
+            parts.append(_numbers(vl, np.float32))
+    coords = np.concatenate(parts) if parts else np.empty(0, np.float32)
+    if coords.size == 0 or coords.size % 9:
+        raise Unsupported("STL sin vértices reconocibles")
+    return dedup(coords.reshape(-1, 3, 3))
+
+def write_stl(path: str, vertices: np.ndarray, faces: np.ndarray):
+    """STL binario (normales calculadas por cara)."""
+    tri = vertices[faces]
+    n = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+    norm = np.linalg.norm(n, axis=1, keepdims=True)
+    n = np.divide(n, norm, out=np.zeros_like(n), where=norm > 0)
+    recs = np.zeros(len(faces), dtype=_STL_REC)
+    recs["normal"] = n
+    recs["v"] = tri
+    with open(path, "wb") as f:
+        f.write(b"MCD binary STL".ljust(80, b" "))
+        f.write(np.uint32(len(faces)).tobytes())
+        recs.tofile(f)
+
+# -------------------- PLY --------------------
+_PLY_TYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4", "double": "f8", "float64": "f8",
+}
+
+def _ply_header(path: str):
+    with open(path, "rb") as f:
+        head = f.read(65536)
+    end = head.find(b"end_header")
+    if head[:3] != b"ply" or end < 0:
+        raise Unsupported("cabecera PLY no válida")
+    body = head.find(b"\n", end) + 1
+    fmt, elements = None, []
+    for line in head[:end].decode("ascii", "replace").splitlines():
+        p = line.split()
+        if not p:
+            continue
+        if p[0] == "format":
+            fmt = p[1]
+        elif p[0] == "element":
+            elements.append({"name": p[1], "count": int(p[2]), "props": []})
+        elif p[0] == "property":
+            elements[-1]["props"].append(p[1:])
+    return fmt, elements, body
+
+def read_ply(path: str):
+    fmt, elements, offset = _ply_header(path)
+    names = [e["name"] for e in elements]
+    if names[:2] != ["vertex", "face"]:
+        raise Unsupported("PLY sin vertex/face al principio")
+    ve, fe = elements[0], elements[1]
+    if any(p[0] == "list" for p in ve["props"]) or len(fe["props"]) != 1 or fe["props"][0][0] != "list":
+        raise Unsupported("propiedades PLY no soportadas")
+    vnames = [p[1] for p in ve["props"]]
+    if not {"x", "y", "z"} <= set(vnames):
+        raise Unsupported("PLY sin coordenadas x/y/z")
+    if not ve["count"] or not fe["count"]:
+        raise Unsupported("PLY vacío")
+    if fmt == "ascii":
+        return _read_ply_ascii(path, offset, ve["count"], fe["count"], vnames)
+    if fmt not in ("binary_little_endian", "binary_big_endian"):
+        raise Unsupported(f"formato PLY {fmt}")
+    bo = "<" if fmt == "binary_little_endian" else ">"
+    try:
+        vdt = np.dtype([(p[1], bo + _PLY_TYPES[p[0]]) for p in ve["props"]])
+        _, ctype, itype, _ = fe["props"][0]
+        # caso habitual: todo triángulos -> registros de tamaño fijo
+        fdt = np.dtype([("n", bo + _PLY_TYPES[ctype]), ("idx", bo + _PLY_TYPES[itype], (3,))])
+    except KeyError as e:
+        raise Unsupported(f"tipo PLY {e}")
+    verts = np.memmap(path, dtype=vdt, mode="r", offset=offset, shape=(ve["count"],))
+    vertices = np.stack([verts["x"], verts["y"], verts["z"]], axis=1).astype(np.float32)
+    offset += vdt.itemsize * ve["count"]
+    if offset + fdt.itemsize * fe["count"] <= os.path.getsize(path):
+        recs = np.memmap(path, dtype=fdt, mode="r", offset=offset, shape=(fe["count"],))
+        if np.all(recs["n"] == 3):
+            return vertices, recs["idx"].astype(np.int32)
+    raise Unsupported("PLY binario con polígonos de más de 3 lados")
+
+def _line_blocks(f, n: int):
+    """Las n líneas siguientes de f en bloques de como mucho ASCII_BLOCK_LINES."""
+    while n > 0:
+        block = list(islice(f, min(n, ASCII_BLOCK_LINES)))
+        if not block:
+            raise Unsupported("PLY truncado")
+        n -= len(block)
+        yield block
+
+def _read_ply_ascii(path: str, offset: int, nv: int, nf: int, vnames: list):
+    xyz = [vnames.index(c) for c in ("x", "y", "z")]
+    vparts, fparts = [], []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for block in _line_blocks(f, nv):
+            vdata = _numbers(block, np.float64)
+            if vdata.size != len(block) * len(vnames):
+                raise Unsupported("PLY con vértices de distinto tamaño")
+            vparts.append(vdata.reshape(len(block), -1)[:, xyz].astype(np.float32))
+        for block in _line_blocks(f, nf):
+            fdata = _numbers(block, np.int64)
+            if fdata.size == 4 * len(block):
+                fdata = fdata.reshape(-1, 4)
+                if np.all(fdata[:, 0] == 3):
+                    fparts.append(fdata[:, 1:].astype(np.int32))
+                    continue
+            fparts.append(_fan([[int(x) for x in l.split()[1:]] for l in block]))
+    return np.concatenate(vparts), np.concatenate(fparts)
+
+def write_ply(path: str, vertices: np.ndarray, faces: np.ndarray, binary: bool = True):
+    header = (
+        "ply\n"
+        f"format {'binary_little_endian' if binary else 'ascii'} 1.0\n"
+        f"element vertex {len(vertices)}\n"
+        "property float x\nproperty float y\nproperty float z\n"
+        f"element face {len(faces)}\n"
+        "property list uchar int vertex_indices\n"
+        "end_header\n"
+    )
+    with open(path, "wb") as f:
+        f.write(header.encode("ascii"))
+        if binary:
+            np.ascontiguousarray(vertices, dtype="<f4").tofile(f)
+            recs = np.empty(len(faces), dtype=[("n", "u1"), ("idx", "<i4", (3,))])
+            recs["n"] = 3
+            recs["idx"] = faces
+            recs.tofile(f)
+        else:
+            np.savetxt(f, vertices, fmt="%.7g")
+            np.savetxt(f, faces, fmt="3 %d %d %d")
+
+# -------------------- OBJ --------------------
+_OBJ_REFS = re.compile(rb"/\S*")  # v/vt/vn -> v
+def _obj_faces(flines: list, seen: np.ndarray) -> np.ndarray:
+    """Caras de un bloque -> triángulos con índices desde 0. seen[k]: vértices definidos
+    antes de la cara k (los índices negativos son relativos a ese punto)."""
+    if all(len(l.split()) == 3 for l in flines):
+        idx = _numbers([_OBJ_REFS.sub(b"", l) for l in flines], np.int64).reshape(-1, 3)
+        return np.where(idx < 0, seen[:, None] + idx, idx - 1).astype(np.int32)
+    polys = []
+    for l, n in zip(flines, seen):
+        p = [int(t.split(b"/", 1)[0]) for t in l.split()]
+        polys.append([i - 1 if i > 0 else n + i for i in p])
+    return _fan(polys)
+
+def read_obj(path: str):
+    vparts, fparts = [], []
+    nv = 0  # vértices definidos hasta la línea en curso
+    with open(path, "rb") as f:
+        while True:
+            block = f.readlines(ASCII_BLOCK_BYTES)
+            if not block:
+                break
+            vlines, flines, seen = [], [], []
+            for l in block:
+                if l.startswith(b"v "):
+                    vlines.append(l[2:])
+                elif l.startswith(b"f "):
+                    flines.append(l[2:])
+                    seen.append(nv + len(vlines))
+            if vlines:
+                widths = {len(l.split()) for l in vlines}
+                if len(widths) == 1:
+                    vdata = _numbers(vlines, np.float32)
+                    vparts.append(vdata.reshape(len(vlines), -1)[:, :3])
+                else:  # número de columnas variable (w, colores...)
+                    vparts.append(np.array([l.split()[:3] for l in vlines], dtype=np.float32))
+                nv += len(vlines)
+            if flines:
+                fparts.append(_obj_faces(flines, np.array(seen)))
+    if not nv or not fparts:
+        raise Unsupported("OBJ sin vértices o caras")
+    return np.concatenate(vparts), np.concatenate(fparts)
+
+def write_obj(path: str, vertices: np.ndarray, faces: np.ndarray):
+    with open(path, "wb") as f:
+        np.savetxt(f, vertices, fmt="v %.7g %.7g %.7g")
+        np.savetxt(f, faces + 1, fmt="f %d %d %d")
+
+# -------------------- API --------------------
+READERS = {"stl": read_stl, "ply": read_ply, "obj": read_obj}
+
+def convert(src_path: str, dst_path: str, dst_ext: str) -> str:
+    src_ext = os.path.splitext(src_path)[1][1:].lower()
+    dst_ext = dst_ext.lower()
+    if not supports(src_ext, dst_ext):
+        raise Unsupported(f"{src_ext} -> {dst_ext}")
+    vertices, faces = READERS[src_ext](src_path)
+    if faces.size and (faces.min() < 0 or faces.max() >= len(vertices)):
+        raise Unsupported("índices de cara fuera de rango")
+    if dst_ext == "stl":
+        write_stl(dst_path, vertices, faces)
+    elif dst_ext == "obj":
+        write_obj(dst_path, vertices, faces)
+    else:
+        write_ply(dst_path, vertices, faces, binary=(dst_ext == "plyb"))
+    return f"native {src_ext} -> {dst_ext}: {len(vertices)} vértices, {len(faces)} caras"
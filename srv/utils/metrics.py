@@ -0,0 +1,106 @@
+# srv/utils/metrics.py
+# Métricas Prometheus de API y workers: tiempo por etapa (subida a la API, espera en
+# cola, conversión, subida a MinIO...), motor usado, profundidad de colas y
+# subprocesos activos. Los workers prefork usan el modo multiproceso de
+# prometheus_client (PROMETHEUS_MULTIPROC_DIR): cada hijo escribe sus valores en
+# ficheros y el proceso principal los agrega al servir /metrics.
+import os, time, shutil, threading
+from contextlib import contextmanager
+
+from prometheus_client import (Counter, Gauge, Histogram, CollectorRegistry, REGISTRY,
+                               CONTENT_TYPE_LATEST, generate_latest, start_http_server)
+from prometheus_client import multiprocess
+
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+STAGE_SECONDS = Histogram(
+    "mcd_stage_seconds", "Duración de cada etapa de un trabajo",
+    ["stage", "kind", "target", "engine"], buckets=STAGE_BUCKETS)
+QUEUE_WAIT_SECONDS = Histogram(
+    "mcd_queue_wait_seconds", "Tiempo en cola hasta que un worker coge la tarea",
+    ["queue"], buckets=STAGE_BUCKETS)
+IMAGE_ENGINE = Counter(
+    "mcd_image_engine_total", "Conversiones de imagen por motor (vips, vips_cli, imagemagick, imagemagick_fallback)",
+    ["engine"])
+TASKS = Counter("mcd_tasks_total", "Tareas terminadas por estado", ["task", "state"])
+QUEUE_DEPTH = Gauge("mcd_queue_depth", "Mensajes en cola", ["queue"], multiprocess_mode="livemax")
+ACTIVE_SUBPROCESSES = Gauge(
+    "mcd_active_subprocesses", "Subprocesos (ffmpeg, vips, assimp...) en marcha", ["tool"],
+    multiprocess_mode="livesum")
+
+# Motor de la etapa en curso en este hilo (lo fija el conversor con engine())
+_local = threading.local()
+
+# Valores admitidos para las etiquetas que vienen del cliente (kind, target): cualquier
+# otro cuenta como "other" para que nadie pueda crear series sin límite
+_allowed = {"kind": None, "target": None}
+
+def allow_labels(kinds, targets):
+    _allowed["kind"], _allowed["target"] = set(kinds), set(targets)
+
+def _label(value: str, which: str) -> str:
+    v = (value or "").strip().lower()
+    allowed = _allowed[which]
+    return v if not v or allowed is None or v in allowed else "other"
+
+def engine(name: str):
+    _local.engine = name
+
+def current_engine() -> str:
+    return getattr(_local, "engine", "")
+
+def begin(engine_name: str = "") -> float:
+    """Empieza a medir una etapa; el motor puede fijarse después con engine()."""
+    _local.engine = engine_name
+    return time.perf_counter()
+
+def end(name: str, t0: float, kind: str = "", target: str = "", timings: dict = None) -> float:
+    """Registra la etapa empezada en t0; si se pasa timings acumula ahí los segundos."""
+    secs = time.perf_counter() - t0
+    observe(name, secs, kind, target, current_engine())
+    if timings is not None:
+        timings[name] = round(timings.get(name, 0) + secs, 3)
+    return secs
+
+@contextmanager
+def stage(name: str, kind: str = "", target: str = "", engine_name: str = "", timings: dict = None):
+    """Mide un bloque como etapa `name` (también si falla)."""
+    t0 = begin(engine_name)
+    try:
+        yield
+    finally:
+        end(name, t0, kind, target, timings)
+
+def observe(name: str, secs: float, kind: str = "", target: str = "", engine_name: str = ""):
+    STAGE_SECONDS.labels(name, _label(kind, "kind"), _label(target, "target"),
+                         engine_name or "").observe(secs)
+
+# -------------------- exposición --------------------
+def registry():
+    if not MULTIPROC_DIR:
+        return REGISTRY
+    reg = CollectorRegistry()
+    multiprocess.MultiProcessCollector(reg)
+    return reg
+
+def exposition() -> tuple:
+    """(cuerpo, content-type) para un endpoint /metrics."""
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+def serve(port: int):
+    """Servidor HTTP de /metrics en un hilo (proceso principal del worker)."""
+    start_http_server(port, registry=registry())
+
+def reset_multiproc_dir():
+    """Al arrancar el worker: descarta valores de ejecuciones anteriores."""
+    if MULTIPROC_DIR:
+        shutil.rmtree(MULTIPROC_DIR, ignore_errors=True)
+        os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+def process_dead(pid: int):
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,212 @@
+# srv/utils/storage.py
+# Capa de almacenamiento S3/MinIO: cliente con pool de conexiones por proceso,
+# comprobación de bucket una sola vez y subidas multipart ajustadas al tamaño.
+import os, time, logging, threading
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+MINIO_URL  = os.getenv("MINIO_URL", "http://minio:9000")
+MINIO_KEY  = os.getenv("MINIO_ACCESS_KEY", "minio")
+MINIO_SEC  = os.getenv("MINIO_SECRET_KEY", "minio12345")
+BUCKET     = os.getenv("MINIO_BUCKET", "jobs")
+INPUT_BUCKET = os.getenv("MINIO_INPUT_BUCKET", "inputs")  # subidas directas del navegador
+PUBLIC_URL = os.getenv("MINIO_PUBLIC_URL")      # ej: http://TU_IP:9000
+
+S3_POOL_CONNECTIONS = int(os.getenv("S3_POOL_CONNECTIONS", "32"))
+S3_MAX_CONCURRENCY  = int(os.getenv("S3_MAX_CONCURRENCY", "8"))   # hilos por subida multipart
+MULTIPART_THRESHOLD = 64 * 1024 * 1024   # por debajo, un único PUT
+MIN_PART = 8 * 1024 * 1024
+MAX_PART = 512 * 1024 * 1024
+S3_MAX_PARTS = 10000
+
+log = logging.getLogger(__name__)
+
+_clients = {}
+_clients_lock = threading.Lock()
+_known_buckets = set()
+
+def client():
+    """Cliente boto3 por proceso (los workers prefork no comparten sockets tras el fork).
+    Es thread-safe: lo usan a la vez los hilos de un batch y los de una subida multipart."""
+    pid = os.getpid()
+    c = _clients.get(pid)
+    if c is None:
+        with _clients_lock:
+            c = _clients.get(pid)
+            if c is None:
+                c = boto3.client(
+                    "s3",
+                    endpoint_url=MINIO_URL,
+                    aws_access_key_id=MINIO_KEY,
+                    aws_secret_access_key=MINIO_SEC,
+                    config=Config(max_pool_connections=S3_POOL_CONNECTIONS,
+                                  retries={"max_attempts": 5, "mode": "standard"}),
+                )
+                _clients.clear()
+                _clients[pid] = c
+                _known_buckets.clear()
+    return c
+
+def ensure_bucket(bucket: str = BUCKET):
+    """head_bucket/create_bucket solo la primera vez por proceso."""
+    if bucket in _known_buckets:
+        return
+    s3 = client()
+    try:
+        s3.head_bucket(Bucket=bucket)
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        if code in ("404", "NoSuchBucket", "NotFound"):
+            try:
+                s3.create_bucket(Bucket=bucket)
+            except ClientError as e2:
+                if e2.response.get("Error", {}).get("Code") not in ("BucketAlreadyOwnedByYou", "BucketAlreadyExists"):
+                    raise
+        else:
+            raise
+    _known_buckets.add(bucket)
+
+def public_url(url: str) -> str:
+    if PUBLIC_URL:
+        ep = urlparse(MINIO_URL)
+        url = url.replace(f"{ep.scheme}://{ep.netloc}", PUBLIC_URL)
+    return url
+
+def part_size_for(size: int) -> int:
+    """Parte de MIN_PART..MAX_PART, y nunca más de S3_MAX_PARTS partes."""
+    part = max(MIN_PART, -(-size // S3_MAX_PARTS))
+    return min(MAX_PART, -(-part // (1024 * 1024)) * 1024 * 1024)
+
+def transfer_config(size: int) -> TransferConfig:
+    part = part_size_for(size)
+    concurrency = max(1, min(S3_MAX_CONCURRENCY, -(-size // part)))
+    return TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=part,
+                          max_concurrency=concurrency, use_threads=concurrency > 1)
+
+def _record(key: str, size: int, secs: float) -> dict:
+    mbps = round(size / secs / 1e6, 2) if secs > 0 else None
+    log.info("upload %s %d bytes in %.2fs (%s MB/s)", key, size, secs, mbps)
+    return {"bytes": size, "seconds": round(secs, 3), "mbps": mbps}
+
+def upload_file(path: str, key: str, bucket: str = BUCKET) -> dict:
+    """Sube path con partes y concurrencia según su tamaño. Devuelve métricas de la subida."""
+    ensure_bucket(bucket)
+    size = os.path.getsize(path)
+    t0 = time.monotonic()
+    client().upload_file(path, bucket, key, Config=transfer_config(size))
+    return _record(key, size, time.monotonic() - t0)
+
+def delete_older_than(bucket: str, max_age_secs: int) -> dict:
+    """Borra los objetos de bucket con más de max_age_secs (en lotes de 1000)."""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=max_age_secs)
+    s3 = client()
+    deleted, size, batch = 0, 0, []
+
+    def flush():
+        nonlocal batch
+        if batch:
+            s3.delete_objects(Bucket=bucket, Delete={"Objects": batch, "Quiet": True})
+            batch = []
+
+    try:
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket):
+            for obj in page.get("Contents", []):
+                if obj["LastModified"] < cutoff:
+                    batch.append({"Key": obj["Key"]})
+                    deleted += 1
+                    size += obj["Size"]
+                    if len(batch) == 1000:
+                        flush()
+        flush()
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "NoSuchBucket":
+            raise
+    return {"objects": deleted, "bytes": size}
+
+def abort_stale_uploads(bucket: str, max_age_secs: int) -> int:
+    """Aborta las subidas multipart sin completar iniciadas hace más de max_age_secs."""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=max_age_secs)
+    s3 = client()
+    aborted = 0
+    try:
+        for page in s3.get_paginator("list_multipart_uploads").paginate(Bucket=bucket):
+            for up in page.get("Uploads", []):
+                if up["Initiated"] < cutoff:
+                    try:
+                        s3.abort_multipart_upload(Bucket=bucket, Key=up["Key"], UploadId=up["UploadId"])
+                        aborted += 1
+                    except ClientError:
+                        pass
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "NoSuchBucket":
+            raise
+    return aborted
+
+class GrowingFileUpload:
+    """Sube un archivo mientras otro proceso lo va escribiendo (multipart por partes
+    completas). Solo vale para salidas que se escriben de forma secuencial y sin volver
+    atrás (p. ej. MPEG-TS); al terminar el productor se llama a finish()."""
+
+    def __init__(self, path: str, key: str, bucket: str = BUCKET, part_size: int = MIN_PART):
+        self.path, self.key, self.bucket, self.part_size = path, key, bucket, part_size
+        self._done = threading.Event()
+        self._error = None
+        self._t0 = time.monotonic()
+        ensure_bucket(bucket)
+        self.upload_id = client().create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+        self._thread = threading.Thread(target=self._pump, daemon=True)
+        self._thread.start()
+
+    def _pump(self):
+        parts, n, size = [], 1, 0
+        try:
+            while not os.path.exists(self.path) and not self._done.is_set():
+                time.sleep(0.2)
+            with open(self.path, "rb") as f:
+                buf = b""
+                while True:
+                    done = self._done.is_set()  # antes de leer: si ya terminó, esta lectura ve todo
+                    chunk = f.read(self.part_size - len(buf))
+                    if chunk:
+                        buf += chunk
+                    if len(buf) >= self.part_size or (done and not chunk and buf):
+                        etag = client().upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                    PartNumber=n, Body=buf)["ETag"]
+                        parts.append({"PartNumber": n, "ETag": etag})
+                        size += len(buf)
+                        n, buf = n + 1, b""
+                    elif done and not chunk:
+                        break
+                    elif not chunk:
+                        time.sleep(0.2)
+            if not parts:  # salida vacía
+                etag = client().upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                            PartNumber=1, Body=b"")["ETag"]
+                parts.append({"PartNumber": 1, "ETag": etag})
+            client().complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                               MultipartUpload={"Parts": parts})
+            self.stats = _record(self.key, size, time.monotonic() - self._t0)
+        except Exception as e:
+            self._error = e
+
+    def finish(self) -> dict:
+        """El productor terminó: sube lo que falte y cierra la subida."""
+        self._done.set()
+        self._thread.join()
+        if self._error:
+            self.abort()
+            raise self._error
+        return self.stats
+
+    def abort(self):
+        self._done.set()
+        self._thread.join()
+        try:
+            client().abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except ClientError:
+            pass
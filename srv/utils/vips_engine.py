@@ -0,0 +1,62 @@
+# srv/utils/vips_engine.py
+# Conversión de imágenes en proceso con libvips (pyvips): sin fork/exec ni shell por imagen.
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pyvips
+    pyvips.cache_set_max(0)  # cada archivo se carga una vez: no cachear operaciones entre tareas
+except (ImportError, OSError):  # OSError si falta la librería nativa
+    pyvips = None
+
+VIPS_THREADS = int(os.getenv("VIPS_THREADS", str(os.cpu_count() or 2)))
+
+# Mismos ajustes por formato que `vips copy in out[...]`
+SAVE_OPTS = {
+    "jpg":  {"Q": 82},
+    "jpeg": {"Q": 82},
+    "png":  {"compression": 9},
+    "webp": {"Q": 82},
+    "avif": {"Q": 60, "effort": 5},
+}
+
+_pool = None
+
+def available() -> bool:
+    return pyvips is not None
+
+def supports(ext: str) -> bool:
+    return available() and ext.lower() in SAVE_OPTS
+
+def convert(src_path: str, dst_path: str, ext: str, **overrides):
+    """Carga en streaming (acceso secuencial) y guarda con los ajustes de SAVE_OPTS."""
+    if not available():
+        raise RuntimeError("pyvips no disponible")
+    opts = {**SAVE_OPTS[ext.lower()], **overrides}
+    img = pyvips.Image.new_from_file(src_path, access="sequential")
+    img.write_to_file(dst_path, **opts)
+    if not os.path.exists(dst_path) or os.path.getsize(dst_path) == 0:
+        raise RuntimeError("Salida de imagen vacía o no creada")
+    return dst_path
+
+def pool() -> ThreadPoolExecutor:
+    """Pool de hilos reutilizado por proceso (libvips libera el GIL)."""
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=VIPS_THREADS, thread_name_prefix="vips")
+    return _pool
+
+def convert_many(src_path: str, outputs: list):
+    """Una sola carga, varias salidas en paralelo: outputs = [(dst_path, ext, size|None)].
+    size reduce la imagen para que quepa en size x size (nunca amplía)."""
+    if not available():
+        raise RuntimeError("pyvips no disponible")
+    img = pyvips.Image.new_from_file(src_path)  # acceso aleatorio: se lee una vez por salida
+
+    def save(dst_path: str, ext: str, size):
+        out = img.thumbnail_image(size, height=size, size="down") if size else img
+        out.write_to_file(dst_path, **SAVE_OPTS[ext.lower()])
+        return dst_path
+
+    futures = [pool().submit(save, *o) for o in outputs]
+    return [f.result() for f in futures]
@@ -1,37 +1,236 @@
-import os, uuid, shutil, tempfile, subprocess
-from celery import Celery
-import boto3
-from urllib.parse import urlparse
-from botocore.exceptions import ClientError  # 👈 añadido
+import os, re, time, uuid, json, signal, shutil, hashlib, logging, tempfile, threading, subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from celery import Celery, Task, chord, signals
+from celery.exceptions import Ignore, SoftTimeLimitExceeded
+from kombu import Queue
+import redis
+from utils import vips_engine, storage, cad_pool, mesh_io, metrics
+from utils.storage import BUCKET, INPUT_BUCKET, client, ensure_bucket
 
 # ====== Config ======
 REDIS_URL  = os.getenv("REDIS_URL", "redis://redis:6379/0")
-MINIO_URL  = os.getenv("MINIO_URL", "http://minio:9000")
-MINIO_KEY  = os.getenv("MINIO_ACCESS_KEY", "minio")
-MINIO_SEC  = os.getenv("MINIO_SECRET_KEY", "minio12345")
-BUCKET     = os.getenv("MINIO_BUCKET", "jobs")
-PUBLIC_URL = os.getenv("MINIO_PUBLIC_URL")      # ej: http://TU_IP:9000
+SHARED_DIR = os.getenv("SHARED_DIR", "/shared")
 TASK_TIMEOUT_SECS = int(os.getenv("TASK_TIMEOUT_SECS", "900"))  # 15 min
+URL_EXPIRES_SECS  = int(os.getenv("URL_EXPIRES_SECS", "21600"))  # 6 h (presigned + caché)
+PROGRESS_INTERVAL_SECS = float(os.getenv("PROGRESS_INTERVAL_SECS", "1"))  # throttle de update_state
+# Vídeos largos: trocear y codificar en paralelo entre workers (0 = desactivado)
+SEGMENT_MIN_SECS = int(os.getenv("SEGMENT_MIN_SECS", "600"))  # duración mínima para trocear
+SEGMENT_SECS     = int(os.getenv("SEGMENT_SECS", "120"))      # duración objetivo de cada trozo
+# Subir la salida mientras se codifica (solo contenedores que se escriben en secuencia)
+UPLOAD_WHILE_ENCODING = os.getenv("UPLOAD_WHILE_ENCODING", "1") == "1"
+STREAMABLE_TARGETS = {"ts"}
+# Batch: los tipos ligeros se agrupan en tareas de BATCH_CHUNK_FILES archivos
+BATCH_CHUNK_FILES = int(os.getenv("BATCH_CHUNK_FILES", "50"))
+# Súbelo al cambiar cualquier preset de conversión: invalida la caché de resultados
+PRESET_VERSION = "3"
+# Límite por tipo (s): al soft salta SoftTimeLimitExceeded dentro de la tarea (mata los
+# subprocesos y limpia); el hard (soft + gracia) mata el proceso del worker
+TIME_LIMITS = {
+    kind: int(os.getenv(f"SOFT_LIMIT_{kind.upper()}_SECS", str(secs)))
+    for kind, secs in {"image": 300, "audio": 600, "mesh": 900, "video": 1800, "download": 1800}.items()
+}
+HARD_LIMIT_GRACE_SECS = int(os.getenv("HARD_LIMIT_GRACE_SECS", "30"))
+# Mantenimiento (celery beat): borra lo caducado de /shared y de los buckets
+JANITOR_INTERVAL_SECS = int(os.getenv("JANITOR_INTERVAL_SECS", "900"))
+JANITOR_GRACE_SECS    = int(os.getenv("JANITOR_GRACE_SECS", "600"))  # margen sobre URL_EXPIRES_SECS
+# Espacio libre mínimo en /shared y tmp: por debajo el worker deja de consumir (0 = sin control)
+MIN_FREE_MB     = int(os.getenv("MIN_FREE_MB", "2048"))
+DISK_CHECK_SECS = int(os.getenv("DISK_CHECK_SECS", "15"))
+# Métricas Prometheus: puerto de /metrics del worker (0 = sin servidor) y desglose
+# de tiempos por etapa en el resultado de cada tarea
+METRICS_PORT   = int(os.getenv("METRICS_PORT", "9100"))
+RESULT_TIMINGS = os.getenv("RESULT_TIMINGS", "0") == "1"
 
-# ====== Celery & S3 ======
-celery = Celery("worker", broker=REDIS_URL, backend=REDIS_URL)
-s3 = boto3.client(
-    "s3",
-    endpoint_url=MINIO_URL,
-    aws_access_key_id=MINIO_KEY,
-    aws_secret_access_key=MINIO_SEC,
+logger = logging.getLogger(__name__)
+
+# ====== Celery & Redis (S3/MinIO en utils/storage.py) ======
+class SupervisedTask(Task):
+    """Al cancelar (DELETE /tasks/{id}) o pasar el soft limit, la tarea recibe
+    SoftTimeLimitExceeded: se matan sus subprocesos (también los lanzados desde hilos)
+    y sus finally limpian salidas parciales. Si fue una cancelación queda REVOKED."""
+
+    def __call__(self, *args, **kwargs):
+        global _subprocess_timeout
+        # los subprocesos de esta tarea viven como mucho su soft limit (no el global)
+        soft = (self.request.timelimit or (None, None))[1]
+        _subprocess_timeout = soft or TASK_TIMEOUT_SECS
+        if _cancelled(self.request):
+            # cancelada sin que llegara el revoke (p. ej. worker reiniciado) o parte de un
+            # trabajo cancelado (trozos de un vídeo segmentado): no se ejecuta
+            _drop_task_inputs(self.name, args, self.request.id)
+            self.backend.mark_as_revoked(self.request.id, "cancelada", request=self.request)
+            raise Ignore()
+        try:
+            return super().__call__(*args, **kwargs)
+        except SoftTimeLimitExceeded:
+            kill_children()
+            if _cancelled(self.request):
+                _drop_task_inputs(self.name, args, self.request.id)
+                self.backend.mark_as_revoked(self.request.id, "cancelada", request=self.request)
+                raise Ignore()
+            raise
+
+celery = Celery("worker", broker=REDIS_URL, backend=REDIS_URL, task_cls=SupervisedTask)
+rds = redis.Redis.from_url(REDIS_URL)
+
+# ====== Colas por tipo ======
+# Cada cola la consume un pool de workers propio (ver docker-compose.yml), así un
+# vídeo 4K nunca ocupa el hueco de cientos de imágenes de menos de un segundo.
+QUEUE_BY_KIND = {"image": "image", "audio": "audio", "video": "video", "mesh": "mesh"}
+DOWNLOAD_QUEUE = "download"
+# Trozos de batch (convert_chunk_task): minutos por mensaje, en su propio pool para que no
+# queden prefetcheados delante de las imágenes interactivas
+BATCH_QUEUE = "batch"
+MAINTENANCE_QUEUE = "maintenance"  # janitor; nunca se pausa por falta de disco
+
+# Prioridades (transporte Redis: 0 = máxima)
+PRIORITY_INTERACTIVE = 2   # /convert, /fetch
+PRIORITY_BATCH       = 6   # cada archivo de /api/convert/batch
+
+celery.conf.update(
+    task_queues=[Queue(q) for q in (*QUEUE_BY_KIND.values(), BATCH_QUEUE, DOWNLOAD_QUEUE, MAINTENANCE_QUEUE)],
+    task_default_queue="image",
+    task_routes={
+        "worker.download_task": {"queue": DOWNLOAD_QUEUE},
+        "worker.janitor_task": {"queue": MAINTENANCE_QUEUE},
+        "worker.convert_chunk_task": {"queue": BATCH_QUEUE},
+        "worker.encode_segment_task": {"queue": "video"},
+        "worker.concat_segments_task": {"queue": "video"},
+    },
+    task_default_priority=PRIORITY_INTERACTIVE,
+    worker_prefetch_multiplier=1,  # tareas pesadas: no acaparar; el pool de imagen lo sube por CLI
+    # priority_steps da la prioridad por mensaje; las colas se reparten en round robin
+    broker_transport_options={"priority_steps": list(range(10))},
+    beat_schedule={"janitor": {"task": "worker.janitor_task", "schedule": JANITOR_INTERVAL_SECS}},
 )
 
-# ====== Ensure bucket ======
-def ensure_bucket():
+def queue_for(kind: str) -> str:
+    return QUEUE_BY_KIND.get(kind, "image")
+
+def time_limits(kind: str, rounds: int = 1) -> dict:
+    """Opciones de apply_async con los límites de `kind` (rounds: tandas seguidas)."""
+    soft = TIME_LIMITS.get(kind, TASK_TIMEOUT_SECS) * rounds
+    return {"soft_time_limit": soft, "time_limit": soft + HARD_LIMIT_GRACE_SECS}
+
+# ====== Cancelación ======
+def _cancel_key(task_id: str) -> str:
+    return f"mcd:cancel:{task_id}"
+
+def _segments_key(task_id: str) -> str:
+    return f"mcd:segments:{task_id}"
+
+def _cancelled(request) -> bool:
+    """Cancelada ella o el trabajo del que forma parte (root_id: el id que ve el cliente)."""
+    ids = {i for i in (request.id, getattr(request, "root_id", None)) if i}
+    return bool(ids) and bool(rds.exists(*[_cancel_key(i) for i in ids]))
+
+def cancel_task(task_id: str):
+    """Cancela una tarea: si está en cola no llega a ejecutarse; si está en marcha
+    recibe SIGUSR1 (= SoftTimeLimitExceeded), que mata sus subprocesos y limpia.
+    Un vídeo segmentado ya no es convert_task sino el chord encode/concat que la
+    sustituyó (el id pasa a concat): sus trozos se revocan también."""
+    rds.set(_cancel_key(task_id), 1, ex=URL_EXPIRES_SECS)
+    raw = rds.get(_segments_key(task_id))
+    seg = json.loads(raw) if raw else {"ids": []}
+    celery.control.revoke([task_id, *seg["ids"]], terminate=True, signal="SIGUSR1")
+    if seg.get("input"):
+        drop_input(seg["input"])  # concat ya no llegará a ejecutarse para borrarla
+
+# ====== Carga: admisión (API) y presets rápidos (workers) ======
+def _per_queue(var: str, defaults: dict) -> dict:
+    return {q: int(os.getenv(f"{var}_{q.upper()}", str(v))) for q, v in defaults.items()}
+
+# Mensajes en cola a partir de los que la API responde 429 (0 = sin límite)
+QUEUE_LIMITS = _per_queue("MAX_QUEUED", {"image": 1000, "audio": 1000, "video": 40, "mesh": 100, "batch": 100, "download": 100})
+# Con la cola por encima de esta marca los workers usan presets rápidos (0 = nunca)
+FAST_WATERMARKS = _per_queue("FAST_PRESET_WATERMARK", {"image": 200, "audio": 200, "video": 6, "mesh": 0, "batch": 10, "download": 0})
+# Procesos que consumen cada cola (ver docker-compose.yml), para estimar Retry-After
+QUEUE_SLOTS = _per_queue("QUEUE_SLOTS", {"image": 4, "audio": 4, "video": 2, "mesh": 1, "batch": 2, "download": 2})
+PRIORITY_SEP = "\x06\x16"  # kombu/Redis: una lista por prioridad, "cola\x06\x16N" (0 = "cola")
+RUNTIME_EWMA_ALPHA = 0.2
+
+def queue_depth(queue: str) -> int:
+    """Mensajes pendientes en la cola (suma de todas sus prioridades)."""
+    pipe = rds.pipeline()
+    for pri in celery.conf.broker_transport_options["priority_steps"]:
+        pipe.llen(f"{queue}{PRIORITY_SEP}{pri}" if pri else queue)
+    return sum(pipe.execute())
+
+def _runtime_key(queue: str) -> str:
+    return f"mcd:runtime:{queue}"
+
+def estimated_wait(queue: str, messages: int) -> float:
+    """Segundos para despachar `messages` mensajes: duración media por tarea / consumidores."""
+    avg = float(rds.get(_runtime_key(queue)) or 30)
+    return messages * avg / max(1, QUEUE_SLOTS.get(queue, 1))
+
+def under_load(kind: str, queue: str = None) -> bool:
+    q = queue or queue_for(kind)
+    mark = FAST_WATERMARKS.get(q, 0)
     try:
-        s3.head_bucket(Bucket=BUCKET)
-    except ClientError as e:
-        code = e.response.get("Error", {}).get("Code")
-        if code in ("404", "NoSuchBucket", "NotFound"):
-            s3.create_bucket(Bucket=BUCKET)
-        else:
-            raise
+        return bool(mark) and queue_depth(q) >= mark
+    except redis.RedisError:
+        return False
+
+_started = {}
+
+@signals.before_task_publish.connect
+def _stamp_enqueued(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault("enqueued_at", time.time())
+
+def queue_wait(request) -> float:
+    """Segundos que pasó la tarea en cola (cabecera enqueued_at puesta al publicar)."""
+    t = getattr(request, "enqueued_at", None)
+    return round(max(0.0, time.time() - t), 3) if t else None
+
+@signals.task_prerun.connect
+def _runtime_start(task_id=None, task=None, **kwargs):
+    _started[task_id] = time.monotonic()
+    wait = queue_wait(task.request) if task else None
+    if wait is not None:
+        queue = (task.request.delivery_info or {}).get("routing_key", "")
+        metrics.QUEUE_WAIT_SECONDS.labels(queue).observe(wait)
+
+@signals.task_postrun.connect
+def _runtime_record(task_id=None, task=None, state=None, **kwargs):
+    """Media móvil de la duración de las tareas de cada cola (para estimated_wait)."""
+    t0 = _started.pop(task_id, None)
+    if task is not None:
+        metrics.TASKS.labels(task.name, state or "").inc()
+    queue = ((task.request.delivery_info or {}).get("routing_key") if task else None)
+    if t0 is None or not queue:
+        return
+    secs = time.monotonic() - t0
+    try:
+        prev = rds.get(_runtime_key(queue))
+        avg = secs if prev is None else float(prev) + RUNTIME_EWMA_ALPHA * (secs - float(prev))
+        rds.set(_runtime_key(queue), round(avg, 3), ex=URL_EXPIRES_SECS)
+    except redis.RedisError:
+        pass
+
+@signals.task_revoked.connect
+def _drop_revoked_inputs(request=None, terminated=False, **kwargs):
+    """Revocada antes de empezar: nadie más borrará su entrada ni liberará la descarga."""
+    if terminated or request is None or not request.args:
+        return
+    _drop_task_inputs(request.name, request.args, request.id)
+
+def _drop_task_inputs(name: str, args, task_id: str):
+    if not args:
+        return
+    if name in ("worker.convert_task", "worker.convert_multi_task"):
+        drop_input(args[0])
+    elif name == "worker.convert_chunk_task":
+        for item in args[0]:
+            drop_input(item["path"])
+    elif name == "worker.download_task":
+        _fetch_release(*args, task_id)
+    elif name == "worker.encode_segment_task":
+        shutil.rmtree(os.path.dirname(args[0]), ignore_errors=True)  # workdir segments_*
+    elif name == "worker.concat_segments_task":
+        drop_input(args[-4])  # original (si estaba en el workdir ya se va con él)
+        shutil.rmtree(args[-1], ignore_errors=True)
 
 # ====== Utils ======
 # ====== Helpers IM/FFmpeg para imágenes ======
@@ -78,156 +277,1039 @@ def convert_image_im(input_path: str, out_path: str, ext: str):
 
     run(cmd)
 
-def run(cmd: str) -> str:
-    """Ejecuta comando y devuelve salida; lanza excepción si RC != 0."""
-    p = subprocess.run(
+# Límite de los subprocesos de la tarea en curso (lo fija SupervisedTask por tarea;
+# prefork: una tarea por proceso a la vez)
+_subprocess_timeout = TASK_TIMEOUT_SECS
+
+def task_timeout() -> float:
+    return _subprocess_timeout
+
+# Subprocesos vivos de este proceso (cada uno líder de su propio grupo)
+_children = set()
+_children_lock = threading.Lock()
+
+def _kill_tree(p: subprocess.Popen):
+    """Mata el grupo entero: la shell y lo que haya lanzado (ffmpeg, yt-dlp...)."""
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def kill_children():
+    with _children_lock:
+        procs = list(_children)
+    for p in procs:
+        _kill_tree(p)
+
+def run(cmd: str, on_line=None, timeout: float = None) -> str:
+    """Ejecuta comando y devuelve salida; lanza excepción si RC != 0.
+    Si se pasa on_line, se llama con cada línea según llega; las líneas para las
+    que devuelva True (progreso ya consumido) no se guardan en el log.
+    El comando va en su propio grupo de procesos: timeout, cancelación o cualquier
+    excepción matan el árbol completo, no solo la shell. Sin timeout se usa el
+    límite de la tarea en curso (task_timeout())."""
+    timeout = timeout or task_timeout()
+    p = subprocess.Popen(
         cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-        text=True, timeout=TASK_TIMEOUT_SECS
+        text=True, bufsize=1, start_new_session=True
     )
+    with _children_lock:
+        _children.add(p)
+    active = metrics.ACTIVE_SUBPROCESSES.labels(os.path.basename(cmd.split(None, 1)[0]))
+    active.inc()
+    timed_out = threading.Event()
+    timer = threading.Timer(timeout, lambda: (timed_out.set(), _kill_tree(p)))
+    timer.start()
+    lines = []
+    try:
+        for line in p.stdout:
+            if on_line and on_line(line):
+                continue
+            lines.append(line)
+        p.wait()
+    except BaseException:
+        _kill_tree(p)
+        p.wait()
+        raise
+    finally:
+        timer.cancel()
+        with _children_lock:
+            _children.discard(p)
+        active.dec()
+        p.stdout.close()
+    out = "".join(lines)
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout, output=out)
     if p.returncode != 0:
-        raise RuntimeError(f"cmd failed ({p.returncode}) -> {cmd}\n--- LOG ---\n{p.stdout}")
-    return p.stdout
+        raise RuntimeError(f"cmd failed ({p.returncode}) -> {cmd}\n--- LOG ---\n{out}")
+    return out
+
+# ====== Progreso (ffmpeg -progress / yt-dlp --newline) ======
+def _publisher(task, stage: str):
+    """Devuelve publish(**meta) que hace update_state(PROGRESS) como mucho cada
+    PROGRESS_INTERVAL_SECS (siempre publica el 100 %)."""
+    last = [0.0]
+
+    def publish(**meta):
+        if task is None or not task.request.id:
+            return
+        now = time.monotonic()
+        if now - last[0] < PROGRESS_INTERVAL_SECS and meta.get("percent") != 100.0:
+            return
+        last[0] = now
+        task.update_state(state="PROGRESS", meta={"stage": stage, **meta})
+    return publish
+
+_DURATION_RE = re.compile(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+
+def ffmpeg_progress(task, stage: str = "encode"):
+    """on_line para ffmpeg lanzado con `-progress pipe:1 -nostats`."""
+    publish = _publisher(task, stage)
+    st = {"duration": None}
+
+    def on_line(line: str) -> bool:
+        if st["duration"] is None:
+            m = _DURATION_RE.search(line)
+            if m:
+                h, mi, sec = m.groups()
+                st["duration"] = int(h) * 3600 + int(mi) * 60 + float(sec)
+                return False
+        k, sep, v = line.strip().partition("=")
+        if not sep or " " in k:
+            return False
+        v = v.strip()
+        if k in ("out_time_us", "out_time_ms") and v.isdigit():
+            st["time"] = int(v) / 1e6  # ambos vienen en microsegundos
+        elif k == "fps":
+            st["fps"] = v
+        elif k == "speed":
+            st["speed"] = v
+        elif k == "progress":
+            dur, t = st["duration"], st.get("time")
+            speed = st.get("speed", "").rstrip("x")
+            meta = {"fps": st.get("fps"), "speed": st.get("speed")}
+            if dur and t is not None:
+                meta["percent"] = 100.0 if v == "end" else round(min(t / dur * 100, 99.9), 1)
+                try:
+                    meta["eta"] = round(max(dur - t, 0) / float(speed)) if float(speed) > 0 else None
+                except ValueError:
+                    meta["eta"] = None
+            publish(**meta)
+        return True
+    return on_line
+
+_YTDLP_PCT_RE   = re.compile(r"^\[download\]\s+([\d.]+)%")
+_YTDLP_SPEED_RE = re.compile(r"\sat\s+(\S+)")
+_YTDLP_ETA_RE   = re.compile(r"\sETA\s+([\d:]+)")
+
+def ytdlp_progress(task, stage: str = "download"):
+    """on_line para yt-dlp lanzado con --newline."""
+    publish = _publisher(task, stage)
+
+    def on_line(line: str) -> bool:
+        m = _YTDLP_PCT_RE.search(line)
+        if not m:
+            return False
+        speed = _YTDLP_SPEED_RE.search(line)
+        eta_m = _YTDLP_ETA_RE.search(line)
+        eta = None
+        if eta_m:
+            eta = 0
+            for part in eta_m.group(1).split(":"):
+                eta = eta * 60 + int(part)
+        publish(percent=float(m.group(1)), speed=speed.group(1) if speed else None, eta=eta)
+        return True
+    return on_line
+
+def new_key(path: str) -> str:
+    return f"{uuid.uuid4().hex}/{os.path.basename(path)}"
+
+def put_object(path: str) -> str:
+    """Sube el archivo al bucket y devuelve su key."""
+    key = new_key(path)
+    storage.upload_file(path, key)
+    return key
+
+def presign(key: str, expires: int = URL_EXPIRES_SECS) -> str:
+    return storage.public_url(client().generate_presigned_url(
+        "get_object", Params={"Bucket": BUCKET, "Key": key}, ExpiresIn=expires
+    ))
 
 def upload(path: str) -> str:
-    ensure_bucket()
-    key = f"{uuid.uuid4().hex}/{os.path.basename(path)}"
-    s3.upload_file(path, BUCKET, key)
-    url = s3.generate_presigned_url(
-        "get_object", Params={"Bucket": BUCKET, "Key": key}, ExpiresIn=21600
+    return presign(put_object(path))
+
+# ====== Entradas en MinIO (subida directa multipart desde el navegador) ======
+# Las tareas reciben "s3://<bucket>/<key>" en lugar de una ruta de /shared
+UPLOAD_PART_BYTES = int(os.getenv("UPLOAD_PART_MB", "16")) * 1024 * 1024
+S3_MAX_PARTS = 10000
+S3_MIN_PART  = 5 * 1024 * 1024
+
+def input_ref(key: str) -> str:
+    return f"s3://{INPUT_BUCKET}/{key}"
+
+def is_object_ref(path: str) -> bool:
+    return path.startswith("s3://")
+
+def _split_ref(ref: str):
+    bucket, _, key = ref[len("s3://"):].partition("/")
+    return bucket, key
+
+def input_part_size(size: int) -> int:
+    return max(UPLOAD_PART_BYTES, S3_MIN_PART, -(-size // S3_MAX_PARTS))
+
+def presign_parts(key: str, upload_id: str, part_numbers) -> list:
+    return [{"part_number": n, "url": storage.public_url(client().generate_presigned_url(
+                "upload_part",
+                Params={"Bucket": INPUT_BUCKET, "Key": key, "UploadId": upload_id, "PartNumber": n},
+                ExpiresIn=URL_EXPIRES_SECS))}
+            for n in part_numbers]
+
+def _declared_key(upload_id: str) -> str:
+    return f"mcd:upload:{upload_id}"
+
+def start_input_upload(filename: str, size: int) -> dict:
+    """Abre una subida multipart en INPUT_BUCKET y devuelve las URLs firmadas de cada parte."""
+    ensure_bucket(INPUT_BUCKET)
+    key = f"{uuid.uuid4().hex}/{os.path.basename(filename)}"
+    upload_id = client().create_multipart_upload(Bucket=INPUT_BUCKET, Key=key)["UploadId"]
+    rds.set(_declared_key(upload_id), size, ex=URL_EXPIRES_SECS)
+    part_size = input_part_size(size)
+    n_parts = max(1, -(-size // part_size))
+    return {"key": key, "upload_id": upload_id, "part_size": part_size,
+            "parts": presign_parts(key, upload_id, range(1, n_parts + 1))}
+
+def uploaded_parts(key: str, upload_id: str) -> list:
+    """Partes ya subidas (para reanudar)."""
+    parts, marker = [], 0
+    while True:
+        r = client().list_parts(Bucket=INPUT_BUCKET, Key=key, UploadId=upload_id, PartNumberMarker=marker)
+        parts += [{"part_number": p["PartNumber"], "etag": p["ETag"], "size": p["Size"]}
+                  for p in r.get("Parts", [])]
+        if not r.get("IsTruncated"):
+            return parts
+        marker = r["NextPartNumberMarker"]
+
+def complete_input_upload(key: str, upload_id: str, parts: list, max_bytes: int = 0) -> str:
+    """Cierra la subida. Las URLs de parte no firman el tamaño, así que el objeto final se
+    comprueba contra el tamaño declarado al abrirla (y max_bytes): si se pasa se borra
+    y lanza ValueError."""
+    client().complete_multipart_upload(
+        Bucket=INPUT_BUCKET, Key=key, UploadId=upload_id,
+        MultipartUpload={"Parts": [{"PartNumber": p["part_number"], "ETag": p["etag"]}
+                                   for p in sorted(parts, key=lambda p: p["part_number"])]},
     )
-    if PUBLIC_URL:
-        ep = urlparse(MINIO_URL)
-        url = url.replace(f"{ep.scheme}://{ep.netloc}", PUBLIC_URL)
-    return url
+    declared = rds.get(_declared_key(upload_id))
+    rds.delete(_declared_key(upload_id))
+    caps = [x for x in (int(declared) if declared else 0, max_bytes) if x]
+    size = client().head_object(Bucket=INPUT_BUCKET, Key=key)["ContentLength"]
+    if caps and size > min(caps):
+        client().delete_object(Bucket=INPUT_BUCKET, Key=key)
+        raise ValueError(f"Archivo demasiado grande ({size} bytes, máximo {min(caps)})")
+    return input_ref(key)
+
+def abort_input_upload(key: str, upload_id: str):
+    client().abort_multipart_upload(Bucket=INPUT_BUCKET, Key=key, UploadId=upload_id)
+
+def local_input(path: str, dest_dir: str) -> str:
+    """Ruta local de la entrada: las de MinIO se descargan a dest_dir."""
+    if not is_object_ref(path):
+        return path
+    bucket, key = _split_ref(path)
+    os.makedirs(dest_dir, exist_ok=True)
+    local = os.path.join(dest_dir, os.path.basename(key))
+    client().download_file(bucket, key, local)
+    return local
+
+def drop_input(path: str):
+    """Borra la entrada ya procesada (archivo de /shared u objeto de MinIO)."""
+    try:
+        if is_object_ref(path):
+            bucket, key = _split_ref(path)
+            client().delete_object(Bucket=bucket, Key=key)
+        else:
+            os.remove(path)
+            parent = os.path.dirname(path)
+            if os.path.dirname(parent) == os.path.normpath(SHARED_DIR):
+                os.rmdir(parent)  # jobdir vacío (falla si quedan archivos del batch)
+    except Exception:
+        pass
+
+# ====== Caché de resultados (content-addressed) ======
+# Objetivos equivalentes
+TARGET_ALIASES = {
+    "jpeg": "jpg",
+    "tif":  "tiff",
+}
+
+def normalize_target(target: str) -> str:
+    """Quita espacios, pasa a minúsculas y resuelve alias."""
+    t = (target or "").strip().lower()
+    return TARGET_ALIASES.get(t, t)
+
+def file_sha256(path: str, chunk: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _cache_key(sha256: str, kind: str, target: str) -> str:
+    return f"mcd:result:{PRESET_VERSION}:{kind}:{normalize_target(target)}:{sha256}"
+
+def _fetch_id(url: str, kind: str, quality: str) -> str:
+    return hashlib.sha256(f"{url}\n{kind}\n{quality}".encode()).hexdigest()
+
+def _fetch_key(url: str, kind: str, quality: str) -> str:
+    return f"mcd:fetch:{PRESET_VERSION}:{_fetch_id(url, kind, quality)}"
+
+def _inflight_key(url: str, kind: str, quality: str) -> str:
+    return f"mcd:fetch:inflight:{_fetch_id(url, kind, quality)}"
+
+def _cache_get(ck: str):
+    """Devuelve un resultado con URL nueva si la entrada existe.
+    La URL caduca con la entrada de caché (el objeto vive lo mismo)."""
+    raw = rds.get(ck)
+    ttl = rds.ttl(ck)
+    if not raw or ttl is None or ttl <= 60:
+        return None
+    entry = json.loads(raw)
+    return {"download_url": presign(entry["key"], ttl), "key": entry["key"], "log": "cache hit", "cached": True}
+
+def _cache_put(ck: str, key: str):
+    rds.set(ck, json.dumps({"key": key}), ex=URL_EXPIRES_SECS)
+
+def cache_lookup(sha256: str, kind: str, target: str):
+    """Resultado de una conversión idéntica ya hecha, o None."""
+    return _cache_get(_cache_key(sha256, kind, target))
+
+def cache_store(sha256: str, kind: str, target: str, key: str):
+    _cache_put(_cache_key(sha256, kind, target), key)
+
+def fetch_lookup(url: str, kind: str, quality: str):
+    """Resultado de una descarga idéntica ya hecha, o None."""
+    return _cache_get(_fetch_key(url, kind, quality))
+
+def _fetch_refs_key(task_id: str) -> str:
+    return f"mcd:fetch:refs:{task_id}"
+
+def fetch_claim(url: str, kind: str, quality: str, task_id: str):
+    """Single-flight: registra task_id como la descarga en curso para (url, kind, quality).
+    Devuelve el id de la tarea que ya estaba en curso, o None si task_id se queda con ella.
+    Cuenta los clientes que esperan cada descarga (ver fetch_detach)."""
+    ik = _inflight_key(url, kind, quality)
+    ttl = time_limits("download")["time_limit"] + 60
+    if rds.set(ik, task_id, nx=True, ex=ttl):
+        rds.set(_fetch_refs_key(task_id), 1, ex=ttl)
+        return None
+    current = rds.get(ik)
+    if not current:
+        return None
+    current = current.decode()
+    pipe = rds.pipeline()
+    pipe.incr(_fetch_refs_key(current))
+    pipe.expire(_fetch_refs_key(current), ttl)
+    pipe.execute()
+    return current
+
+def fetch_detach(task_id: str) -> int:
+    """Un cliente deja de esperar la descarga task_id. Devuelve cuántos siguen esperándola
+    (0: era el último y se puede cancelar; -1: no es una descarga compartida en curso)."""
+    rk = _fetch_refs_key(task_id)
+    if not rds.exists(rk):
+        return -1
+    left = rds.decr(rk)
+    if left <= 0:
+        rds.delete(rk)
+    return max(0, left)
+
+def _fetch_release(url: str, kind: str, quality: str, task_id: str):
+    ik = _inflight_key(url, kind, quality)
+    current = rds.get(ik)
+    if current and current.decode() == task_id:
+        rds.delete(ik)
+    rds.delete(_fetch_refs_key(task_id))
+
+# ====== Vídeo: presets y remux sin recodificar ======
+VIDEO_ENC = {
+    "mp4":  '-c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 128k',
+    "m4v":  '-c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 128k',
+    "mov":  '-c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 160k',
+    "webm": '-c:v libvpx-vp9 -b:v 0 -crf 30 -c:a libopus',
+    "mkv":  '-c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 128k',
+    "avi":  '-c:v mpeg4 -qscale:v 5 -c:a libmp3lame -q:a 4',
+    "mpeg": '-c:v mpeg2video -qscale:v 4 -c:a mp2 -b:a 192k',
+    "mpg":  '-c:v mpeg2video -qscale:v 4 -c:a mp2 -b:a 192k',
+    "ts":   '-c:v libx264 -preset veryfast -crf 23 -c:a aac -bsf:v h264_mp4toannexb -f mpegts',
+    "3gp":  '-c:v libx264 -profile:v baseline -level 3.0 -vf scale=w=640:h=-2 -c:a aac -b:a 96k',
+    "3g2":  '-c:v libx264 -profile:v baseline -level 3.0 -vf scale=w=640:h=-2 -c:a aac -b:a 96k',
+    "ogv":  '-c:v libtheora -q:v 7 -c:a libvorbis -q:a 5',
+    "flv":  '-c:v flv -q:v 7 -c:a libmp3lame -q:a 4'
+}
+
+# Códecs que cada contenedor admite tal cual (-c copy)
+REMUX_VIDEO = {
+    "mp4":  {"h264", "hevc", "av1", "mpeg4"},
+    "m4v":  {"h264", "hevc", "mpeg4"},
+    "mov":  {"h264", "hevc", "mpeg4", "prores", "mjpeg"},
+    "mkv":  {"h264", "hevc", "av1", "vp8", "vp9", "mpeg4", "mpeg2video", "theora"},
+    "webm": {"vp8", "vp9", "av1"},
+    "ts":   {"h264", "hevc", "mpeg2video"},
+}
+REMUX_AUDIO = {
+    "mp4":  {"aac", "mp3", "alac", "ac3", "eac3"},
+    "m4v":  {"aac", "mp3", "ac3"},
+    "mov":  {"aac", "mp3", "alac", "pcm_s16le", "pcm_s24le"},
+    "mkv":  {"aac", "mp3", "opus", "vorbis", "flac", "ac3", "eac3", "dts", "pcm_s16le"},
+    "webm": {"opus", "vorbis"},
+    "ts":   {"aac", "mp3", "mp2", "ac3"},
+}
+# Audio a recodificar cuando el vídeo se copia pero el audio no cabe (mismo criterio que VIDEO_ENC)
+REMUX_AUDIO_ENC = {
+    "mp4":  "-c:a aac -b:a 128k",
+    "m4v":  "-c:a aac -b:a 128k",
+    "mov":  "-c:a aac -b:a 160k",
+    "mkv":  "-c:a aac -b:a 128k",
+    "webm": "-c:a libopus",
+    "ts":   "-c:a aac",
+}
+
+# Tier rápido bajo carga: mismo CRF (misma calidad), más bitrate/tamaño a cambio de CPU
+FAST_X264_PRESET = os.getenv("FAST_X264_PRESET", "superfast")
+
+def video_enc(t: str, fast: bool = False) -> str:
+    args = VIDEO_ENC[t]
+    if fast:
+        args = (args.replace("-preset veryfast", f"-preset {FAST_X264_PRESET}")
+                    .replace("-c:v libvpx-vp9", "-c:v libvpx-vp9 -deadline realtime -cpu-used 8"))
+    return args
+
+def probe_streams(input_path: str) -> list:
+    out = run(f'ffprobe -v error -show_entries stream=index,codec_type,codec_name'
+              f':stream_disposition=attached_pic -of json "{input_path}"')
+    return json.loads(out).get("streams", [])
+
+def remux_plan(input_path: str, t: str):
+    """Si los streams del origen caben en el contenedor destino devuelve
+    (args ffmpeg, etiqueta) para copiarlos sin recodificar; si no, None."""
+    if t not in REMUX_VIDEO:
+        return None
+    try:
+        streams = probe_streams(input_path)
+    except Exception:
+        return None
+    video = [st for st in streams if st.get("codec_type") == "video"
+             and not st.get("disposition", {}).get("attached_pic")]
+    audio = [st for st in streams if st.get("codec_type") == "audio"]
+    if not video or video[0].get("codec_name") not in REMUX_VIDEO[t]:
+        return None
+    maps = f'-map 0:{video[0]["index"]} -map 0:a?'
+    faststart = " -movflags +faststart" if t in ("mp4", "m4v", "mov") else ""
+    if all(a.get("codec_name") in REMUX_AUDIO[t] for a in audio):
+        return f"{maps} -c copy{faststart}", "remux (copy)"
+    return f"{maps} -c:v copy {REMUX_AUDIO_ENC[t]}{faststart}", "remux (copy video, encode audio)"
+
+# ====== Vídeo largo: split -> encode en paralelo -> concat ======
+# Contenedores cuyos trozos se pueden unir sin pérdidas con el demuxer concat
+SEGMENTABLE = {"mp4", "m4v", "mov", "mkv", "webm", "ts"}
+
+def probe_duration(input_path: str) -> float:
+    out = run(f'ffprobe -v error -show_entries format=duration -of csv=p=0 "{input_path}"')
+    try:
+        return float(out.strip())
+    except ValueError:
+        return 0.0
+
+def segment_video_args(t: str, fast: bool = False) -> str:
+    """Parte de vídeo del preset (el audio se codifica una sola vez al unir)."""
+    return video_enc(t, fast).split(" -c:a ")[0]
+
+def split_video(input_path: str, workdir: str) -> list:
+    """Corta solo el vídeo en keyframes (-c copy) en trozos de ~SEGMENT_SECS."""
+    run(f'ffmpeg -y -i "{input_path}" -map 0:v:0 -an -sn -c copy -f segment '
+        f'-segment_time {SEGMENT_SECS} -reset_timestamps 1 "{workdir}/seg_%05d.mkv"')
+    return sorted(os.path.join(workdir, f) for f in os.listdir(workdir) if f.startswith("seg_"))
+
+@celery.task(bind=True)
+def encode_segment_task(self, seg_path: str, t: str, fast: bool = False) -> str:
+    out = seg_path.replace("seg_", "enc_", 1)
+    run(f'ffmpeg -y -i "{seg_path}" -an {segment_video_args(t, fast)} "{out}"')
+    os.remove(seg_path)
+    return out
+
+@celery.task(bind=True)
+def concat_segments_task(self, parts: list, input_path: str, t: str, sha256: str, workdir: str):
+    """Une los trozos sin recodificar, añade el audio del original y sube el resultado."""
+    try:
+        base = os.path.splitext(os.path.basename(input_path))[0]
+        out = os.path.join(workdir, f"{base}.{t}")
+        listfile = os.path.join(workdir, "concat.txt")
+        with open(listfile, "w") as lf:
+            lf.writelines(f"file '{p}'\n" for p in parts)
+        log = run(
+            f'ffmpeg -y -progress pipe:1 -nostats -f concat -safe 0 -i "{listfile}" -i "{input_path}" '
+            f'-map 0:v -map 1:a? -c:v copy {REMUX_AUDIO_ENC[t]} "{out}"',
+            ffmpeg_progress(self, "concat"))
+        key = put_object(out)
+        cache_store(sha256, "video", t, key)
+        return {"download_url": presign(key), "key": key, "log": f"[segmented x{len(parts)}]\n{log}"}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        try:
+            os.remove(input_path)
+        except Exception:
+            pass
+
+def segmented_encode(task, input_path: str, t: str, sha256: str, fast: bool = False):
+    """Si el vídeo es largo, lo trocea y devuelve el chord encode/concat con el que
+    sustituir la tarea (el task_id original recibe el resultado final); si no, None."""
+    if not SEGMENT_MIN_SECS or t not in SEGMENTABLE:
+        return None
+    if probe_duration(input_path) < SEGMENT_MIN_SECS:
+        return None
+    # los trozos van al volumen compartido para que cualquier worker los lea
+    workdir = os.path.join(SHARED_DIR, f"segments_{uuid.uuid4().hex}")
+    os.makedirs(workdir)
+    try:
+        parts = split_video(input_path, workdir)
+    except Exception:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+    if len(parts) < 2:
+        # sin keyframes intermedios: codificación normal (la entrada sigue en su sitio)
+        shutil.rmtree(workdir, ignore_errors=True)
+        return None
+    if not input_path.startswith(SHARED_DIR + os.sep):
+        # entrada descargada de MinIO a tmp local: concat_segments_task también la necesita
+        os.makedirs(os.path.join(workdir, "src"))
+        input_path = shutil.move(input_path, os.path.join(workdir, "src"))
+    task.update_state(state="PROGRESS", meta={"stage": "segments", "segments": len(parts)})
+    # ids fijados de antemano: cancel_task revoca los trozos a partir del id original
+    ids = [uuid.uuid4().hex for _ in parts]
+    rds.set(_segments_key(task.request.id), json.dumps({"ids": ids, "input": input_path}),
+            ex=URL_EXPIRES_SECS)
+    return chord(
+        # el tier (fast) se decide una vez: todos los trozos con el mismo preset
+        [encode_segment_task.s(p, t, fast).set(task_id=i, **time_limits("video")) for p, i in zip(parts, ids)],
+        concat_segments_task.s(input_path, t, sha256, workdir).set(**time_limits("video")),
+    )
+
+# ====== Malla: destinos que resuelven FreeCAD/Blender ======
+CAD_TARGETS = {"3mf": "freecad", "step": "freecad", "iges": "freecad", "blend": "blender"}
+ASSIMP_FORMATS = {
+    "obj":"obj","stl":"stl","ply":"ply","plyb":"plyb","fbx":"fbx",
+    "3ds":"3ds","dae":"collada","x":"x","off":"off",
+    "gltf":"gltf2","glb":"glb2",
+}
+
+def convert_mesh(input_path: str, out: str, t: str) -> str:
+    """STL/PLY/OBJ entre sí en proceso (utils/mesh_io.py); el resto, o si falla, con assimp."""
+    src_ext = os.path.splitext(input_path)[1][1:].lower()
+    log = ""
+    if mesh_io.supports(src_ext, t):
+        try:
+            metrics.engine("native")
+            return mesh_io.convert(input_path, out, t)
+        except Exception as e_native:
+            log = f"[native failed]\n{e_native}\n\n[assimp]\n"
+    metrics.engine("assimp")
+    return log + run(f'assimp export "{input_path}" "{out}" -f {ASSIMP_FORMATS[t]}')
+
+# ====== Imagen ======
+# Tier rápido bajo carga: misma Q, menos esfuerzo de compresión (archivos algo mayores)
+FAST_VIPS_OPTS = {"png": {"compression": 3}, "webp": {"effort": 1}, "avif": {"effort": 2}}
+FAST_IM_DEFINES = {"png": "png:compression-level=3", "webp": "webp:method=2", "avif": "heic:speed=8"}
+# Destinos que van directos a ImageMagick
+IMAGE_IM_TARGETS = {"bmp", "tiff", "ico", "psd", "exr", "jp2", "heic", "heif", "gif"}
+
+def convert_image(input_path: str, out: str, t: str, fast: bool = False) -> str:
+    """Convierte una imagen a `t` (ya normalizado); devuelve el log."""
+    # Formatos que intentamos primero con VIPS por rendimiento
+    vips_ok = {"jpg", "jpeg", "png", "webp", "avif"}
+
+    if t in vips_ok:
+        IM = _im_bin()
+        if t in ("jpg", "jpeg"):
+            im_args = "-colorspace sRGB -interlace Plane -quality 82"
+        elif t == "png":
+            im_args = "-define png:compression-level=9"
+        elif t == "webp":
+            im_args = "-define webp:method=6 -quality 82"
+        elif t == "avif":
+            im_args = "-define heic:speed=4 -quality 60"
+        else:
+            raise ValueError("formato de imagen no soportado")
+        overrides = FAST_VIPS_OPTS.get(t, {}) if fast else {}
+        if t in FAST_IM_DEFINES and fast:
+            im_args = re.sub(r"-define \S+", f"-define {FAST_IM_DEFINES[t]}", im_args)
+        opts = {**vips_engine.SAVE_OPTS[t], **overrides}
+        cmd_vips = f'vips copy "{input_path}" "{out}"[{",".join(f"{k}={v}" for k, v in opts.items())}]'
+        cmd_im   = f'{IM} "{input_path}" -auto-orient -strip {im_args} "{out}"'
+
+        # VIPS primero (en proceso si hay pyvips); si falla, fallback a ImageMagick
+        try:
+            if vips_engine.supports(t):
+                engine = "vips"
+                vips_engine.convert(input_path, out, t, **overrides)
+                log = f"libvips -> {t}"
+            else:
+                engine = "vips_cli"
+                log = run(cmd_vips)
+        except Exception as e_vips:
+            try:
+                engine = "imagemagick_fallback"
+                log = f"[vips failed]\n{e_vips}\n\n[trying ImageMagick]\n" + run(cmd_im)
+            except Exception as e_im:
+                raise RuntimeError(f"Imagen: falló vips e ImageMagick:\n{e_vips}\n\n{e_im}")
+
+    # Resto de formatos (IM directo)
+    elif t in IMAGE_IM_TARGETS:
+        engine = "imagemagick"
+        convert_image_im(input_path, out, t)
+        log = f"ImageMagick -> {t}"
+
+    # SVG como salida no tiene sentido (vector real). Solo usar SVG como entrada.
+    elif t == "svg":
+        raise ValueError("SVG como salida no soportado (solo entrada).")
+
+    else:
+        raise ValueError("formato de imagen no soportado")
+    metrics.engine(engine)
+    metrics.IMAGE_ENGINE.labels(engine).inc()
+    return log
+
+# ====== Audio ======
+AUDIO_ENC = {
+    "mp3":  "-c:a libmp3lame -q:a 2",
+    "m4a":  "-c:a aac -b:a 192k",
+    "aac":  "-c:a aac -b:a 192k",
+    "opus": "-c:a libopus -b:a 128k",
+    "ogg":  "-c:a libvorbis -q:a 5",
+    "wav":  "-c:a pcm_s16le",
+    "flac": "-c:a flac -compression_level 5",
+}
+# Opciones del contenedor (se aplican también al copiar)
+AUDIO_MUX = {"m4a": "-movflags +faststart", "aac": "-f adts"}
+# Códecs que cada destino admite tal cual (-c:a copy)
+AUDIO_COPY = {
+    "mp3":  {"mp3"},
+    "m4a":  {"aac", "alac"},
+    "aac":  {"aac"},
+    "opus": {"opus"},
+    "ogg":  {"vorbis", "opus", "flac"},
+    "wav":  {"pcm_s16le", "pcm_s24le", "pcm_s32le", "pcm_f32le", "pcm_u8"},
+    "flac": {"flac"},
+}
+# Tier rápido bajo carga: mismo bitrate/calidad, menos esfuerzo del codificador
+FAST_AUDIO_ENC = {
+    "mp3":  "-c:a libmp3lame -q:a 2 -compression_level 7",
+    "opus": "-c:a libopus -b:a 128k -compression_level 3",
+    "flac": "-c:a flac -compression_level 0",
+}
+# Archivos cortos por invocación de ffmpeg en los batches (arranque del proceso y
+# apertura de códecs se pagan una vez por grupo, no por archivo)
+AUDIO_FILES_PER_FFMPEG = int(os.getenv("AUDIO_FILES_PER_FFMPEG", "8"))
+
+def audio_args(codec: str, t: str, fast: bool = False) -> tuple:
+    """(args ffmpeg, etiqueta) para llevar un stream de audio `codec` a `t`."""
+    if t not in AUDIO_ENC:
+        raise ValueError("formato de audio no soportado")
+    mux = AUDIO_MUX.get(t, "")
+    if codec in AUDIO_COPY[t]:
+        return f"-c:a copy {mux}".strip(), "copy"
+    args = FAST_AUDIO_ENC.get(t, AUDIO_ENC[t]) if fast else AUDIO_ENC[t]
+    return f"{args} {mux}".strip(), "encode"
+
+def convert_audio(input_path: str, out: str, t: str, fast: bool = False, on_line=None) -> str:
+    """Convierte el primer stream de audio (sin carátula ni vídeo); copia si ya sirve."""
+    audio = [st for st in probe_streams(input_path) if st.get("codec_type") == "audio"]
+    if not audio:
+        raise ValueError("el archivo no tiene pista de audio")
+    args, label = audio_args(audio[0].get("codec_name"), t, fast)
+    metrics.engine("remux" if label == "copy" else "ffmpeg")
+    return f"[{label}]\n" + run(
+        f'ffmpeg -y -progress pipe:1 -nostats -i "{input_path}" '
+        f'-map 0:{audio[0]["index"]} -map_metadata 0 {args} "{out}"', on_line)
+
+_AUDIO_STREAM_RE = re.compile(r"Stream #(\d+):\d+\S*: Audio: (\w+)")
+
+def audio_codecs(paths: list) -> list:
+    """Códec del primer stream de audio de cada entrada (None si no tiene) con un solo
+    proceso: ffmpeg sin salida solo lee las cabeceras y termina con RC 1."""
+    cmd = "ffmpeg -hide_banner -nostdin " + " ".join(f'-i "{p}"' for p in paths)
+    try:
+        out = run(cmd)
+    except RuntimeError as e:
+        out = str(e)
+    codecs = [None] * len(paths)
+    for m in _AUDIO_STREAM_RE.finditer(out):
+        i = int(m.group(1))
+        if i < len(codecs) and codecs[i] is None:
+            codecs[i] = m.group(2)
+    return codecs
+
+def convert_audio_many(jobs: list, t: str, fast: bool = False) -> list:
+    """Convierte [(entrada, salida)] con un único ffmpeg (una salida por entrada).
+    Devuelve por job el log o la excepción; si el grupo falla se reintenta archivo a
+    archivo para que el error quede solo en el que lo provoca."""
+    if len(jobs) == 1:
+        try:
+            return [convert_audio(jobs[0][0], jobs[0][1], t, fast)]
+        except Exception as e:
+            return [e]
+    results = [None] * len(jobs)
+    inputs, outputs = "", ""
+    n, alone = 0, []
+    for i, codec in enumerate(audio_codecs([p for p, _ in jobs])):
+        if codec is None:
+            # sin pista o sin leer (ffmpeg se detiene en la primera entrada que no abre):
+            # se prueba aparte para que el error sea el suyo
+            alone.append(i)
+            continue
+        args, label = audio_args(codec, t, fast)
+        inputs += f' -i "{jobs[i][0]}"'
+        outputs += f' -map {n}:a:0 -map_metadata {n} {args} "{jobs[i][1]}"'
+        results[i] = f"[{label}]"
+        n += 1
+    if n:
+        metrics.engine("ffmpeg_group")
+        try:
+            log = run(f"ffmpeg -y -hide_banner -nostdin -v error{inputs}{outputs}")
+            results = [f"{r} ffmpeg x{n} -> {t}\n{log}".rstrip() if r else r for r in results]
+        except Exception as e_group:
+            for i, (path, out) in enumerate(jobs):
+                if results[i]:
+                    try:
+                        results[i] = (f"[grupo de {n} falló -> archivo a archivo]\n"
+                                      + convert_audio(path, out, t, fast))
+                    except Exception as e:
+                        results[i] = RuntimeError(f"{e}\n\n[grupo]\n{e_group}")
+    for i in alone:
+        try:
+            results[i] = convert_audio(jobs[i][0], jobs[i][1], t, fast)
+        except Exception as e:
+            results[i] = e
+    return results
 
 # ====== Tareas ======
 @celery.task(bind=True)
-def convert_task(self, input_path: str, kind: str, target: str):
+def convert_task(self, input_path: str, kind: str, target: str, sha256: str = None):
     tmpdir = tempfile.mkdtemp()
+    src = input_path    # ruta de /shared o s3://bucket/key
+    keep_input = False  # el modo troceado sigue usando el original
+    key = None          # ya subido si la salida se sube mientras se codifica
+    timings = {"queue_wait": queue_wait(self.request)}
     try:
+        t0 = metrics.begin()
+        input_path = local_input(src, os.path.join(tmpdir, "in"))
+        if input_path != src:
+            metrics.end("input_fetch", t0, kind, target, timings)
         base = os.path.splitext(os.path.basename(input_path))[0]
-        # Normaliza el formato de salida (quita espacios, pasa a minúsculas y resuelve alias)
-        t_raw = (target or "").strip().lower()
-        ALIASES = {
-            "jpeg": "jpg",
-            "tif":  "tiff",
-        }
-        t = ALIASES.get(t_raw, t_raw)
+        # Normaliza el formato de salida
+        t = normalize_target(target)
+        sha256 = sha256 or file_sha256(input_path)
+        hit = cache_lookup(sha256, kind, t)
+        if hit:
+            return hit
         out = os.path.join(tmpdir, f"{base}.{t}")
+        fast = under_load(kind)  # cola por encima de la marca: presets rápidos
 
+        t0 = metrics.begin()  # el conversor fija el motor con metrics.engine()
         if kind == "video":
-            enc = {
-                "mp4":  '-c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 128k',
-                "m4v":  '-c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 128k',
-                "mov":  '-c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 160k',
-                "webm": '-c:v libvpx-vp9 -b:v 0 -crf 30 -c:a libopus',
-                "mkv":  '-c:v libx264 -preset veryfast -crf 23 -c:a aac -b:a 128k',
-                "avi":  '-c:v mpeg4 -qscale:v 5 -c:a libmp3lame -q:a 4',
-                "mpeg": '-c:v mpeg2video -qscale:v 4 -c:a mp2 -b:a 192k',
-                "mpg":  '-c:v mpeg2video -qscale:v 4 -c:a mp2 -b:a 192k',
-                "ts":   '-c:v libx264 -preset veryfast -crf 23 -c:a aac -bsf:v h264_mp4toannexb -f mpegts',
-                "3gp":  '-c:v libx264 -profile:v baseline -level 3.0 -vf scale=w=640:h=-2 -c:a aac -b:a 96k',
-                "3g2":  '-c:v libx264 -profile:v baseline -level 3.0 -vf scale=w=640:h=-2 -c:a aac -b:a 96k',
-                "ogv":  '-c:v libtheora -q:v 7 -c:a libvorbis -q:a 5',
-                "flv":  '-c:v flv -q:v 7 -c:a libmp3lame -q:a 4'
-            }
             if t == "gif":
                 palette = os.path.join(tmpdir, "palette.png")
                 _ = run(f'ffmpeg -y -i "{input_path}" -vf "fps=12,scale=iw:-1:flags=lanczos,palettegen" "{palette}"')
-                cmd = f'ffmpeg -y -i "{input_path}" -i "{palette}" -lavfi "fps=12,scale=iw:-1:flags=lanczos [x]; [x][1:v] paletteuse" -loop 0 "{out}"'
-            elif t in enc:
-                cmd = f'ffmpeg -y -i "{input_path}" {enc[t]} "{out}"'
+                cmd = f'ffmpeg -y -progress pipe:1 -nostats -i "{input_path}" -i "{palette}" -lavfi "fps=12,scale=iw:-1:flags=lanczos [x]; [x][1:v] paletteuse" -loop 0 "{out}"'
+            elif t in VIDEO_ENC:
+                cmd = f'ffmpeg -y -progress pipe:1 -nostats -i "{input_path}" {video_enc(t, fast)} "{out}"'
             else:
                 raise ValueError("formato de video no soportado")
-            log = run(cmd)
 
-        elif kind == "image":
-            # Formatos que intentamos primero con VIPS por rendimiento
-            vips_ok = {"jpg", "jpeg", "png", "webp", "avif"}
-
-            if t in vips_ok:
-                IM = _im_bin()
-                if t in ("jpg", "jpeg"):
-                    cmd_vips = f'vips copy "{input_path}" "{out}"[Q=82]'
-                    cmd_im   = f'{IM} "{input_path}" -auto-orient -strip -colorspace sRGB -interlace Plane -quality 82 "{out}"'
-                elif t == "png":
-                    cmd_vips = f'vips copy "{input_path}" "{out}"[compression=9]'
-                    cmd_im   = f'{IM} "{input_path}" -auto-orient -strip -define png:compression-level=9 "{out}"'
-                elif t == "webp":
-                    cmd_vips = f'vips copy "{input_path}" "{out}"[Q=82]'
-                    cmd_im   = f'{IM} "{input_path}" -auto-orient -strip -define webp:method=6 -quality 82 "{out}"'
-                elif t == "avif":
-                    cmd_vips = f'vips copy "{input_path}" "{out}"[Q=60,effort=5]'
-                    cmd_im   = f'{IM} "{input_path}" -auto-orient -strip -define heic:speed=4 -quality 60 "{out}"'
-                else:
-                    raise ValueError("formato de imagen no soportado")
-
-                # VIPS primero; si falla, fallback a ImageMagick
+            # Fast path: si los códecs ya sirven para el contenedor, solo se remuxa
+            plan = remux_plan(input_path, t) if t != "gif" else None
+            segments = None if plan else segmented_encode(self, input_path, t, sha256, fast)
+            if segments:
+                keep_input = True  # lo borra concat_segments_task
+                raise self.replace(segments)
+            log = ""
+            if plan:
+                args, label = plan
                 try:
-                    log = run(cmd_vips)
-                except Exception as e_vips:
-                    try:
-                        log = f"[vips failed]\n{e_vips}\n\n[trying ImageMagick]\n" + run(cmd_im)
-                    except Exception as e_im:
-                        raise RuntimeError(f"Imagen: falló vips e ImageMagick:\n{e_vips}\n\n{e_im}")
-
-            # Resto de formatos (IM directo)
-            elif t in {"bmp", "tiff", "ico", "psd", "exr", "jp2", "heic", "heif", "gif"}:
-                convert_image_im(input_path, out, t)
-                log = f"ImageMagick -> {t}"
-
-            # SVG como salida no tiene sentido (vector real). Solo usar SVG como entrada.
-            elif t == "svg":
-                raise ValueError("SVG como salida no soportado (solo entrada).")
+                    log = f"[{label}]\n" + run(
+                        f'ffmpeg -y -progress pipe:1 -nostats -i "{input_path}" {args} "{out}"',
+                        ffmpeg_progress(self, "remux"))
+                    metrics.engine("remux")
+                except Exception as e_remux:
+                    log = f"[{label} failed -> encode]\n{e_remux}\n\n"
+                    plan = None
+            if not plan and UPLOAD_WHILE_ENCODING and t in STREAMABLE_TARGETS:
+                # la subida multipart avanza a la vez que ffmpeg escribe
+                key = new_key(out)
+                up = storage.GrowingFileUpload(out, key)
+                metrics.engine("ffmpeg_stream")
+                try:
+                    log += "[encode + streaming upload]\n" + run(cmd, ffmpeg_progress(self))
+                except Exception:
+                    up.abort()
+                    raise
+                up.finish()
+            elif not plan:
+                metrics.engine("ffmpeg")
+                log += "[encode]\n" + run(cmd, ffmpeg_progress(self))
 
-            else:
-                raise ValueError("formato de imagen no soportado")
+        elif kind == "image":
+            log = convert_image(input_path, out, t, fast)
 
+        elif kind == "audio":
+            log = convert_audio(input_path, out, t, fast, ffmpeg_progress(self))
 
         elif kind == "mesh":
-            assimp_map = {
-                "obj":"obj","stl":"stl","ply":"ply","plyb":"plyb","fbx":"fbx",
-                "3ds":"3ds","dae":"collada","x":"x","off":"off",
-                "gltf":"gltf2","glb":"glb2",
-            }
-            if t == "3mf":
-                fc_script = os.path.join(tmpdir, "export_3mf.py")
-                with open(fc_script, "w") as fcs:
-                    fcs.write(f"""
-import Mesh, FreeCAD as App
-doc = App.newDocument()
-m = Mesh.Mesh()
-m.read(r"{input_path}")
-obj = doc.addObject("Mesh::Feature","Mesh")
-obj.Mesh = m
-doc.recompute()
-Mesh.export([obj], r"{out}")
-print("OK")
-""")
-                cmd = f'freecadcmd "{fc_script}"'
-                log = run(cmd)
-            elif t in assimp_map:
-                cmd = f'assimp export "{input_path}" "{out}" -f {assimp_map[t]}'
-                log = run(cmd)
-            elif t in ("blend","step","iges","dxf","dwg"):
-                raise ValueError("BLEND/STEP/IGES/DXF/DWG requieren Blender/FreeCAD/ODA (pendiente).")
+            if t in CAD_TARGETS:
+                # procesos FreeCAD/Blender persistentes (utils/cad_pool.py)
+                tool = CAD_TARGETS[t]
+                metrics.engine(tool)
+                log = f"[{tool}]\n" + cad_pool.convert(tool, input_path, out, t, task_timeout())
+            elif t in ASSIMP_FORMATS:
+                log = convert_mesh(input_path, out, t)
+            elif t in ("dxf","dwg"):
+                raise ValueError("DXF/DWG requieren ODA (pendiente).")
             else:
                 raise ValueError("formato 3D no soportado")
         else:
             raise ValueError("kind inválido")
+        metrics.end("convert", t0, kind, t, timings)
+
+        if fast:
+            log = "[carga alta: presets rápidos]\n" + log
+        if key is None:
+            with metrics.stage("storage_upload", kind, t, timings=timings):
+                key = put_object(out)
+        cache_store(sha256, kind, t, key)
+        result = {"download_url": presign(key), "key": key, "log": log}
+        if RESULT_TIMINGS:
+            result["timings"] = timings
+        return result
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if src != input_path:
+            drop_input(src)  # objeto de MinIO ya descargado
+        if not keep_input:
+            drop_input(input_path)
+
+def submit_convert(input_path: str, kind: str, target: str, sha256: str = None,
+                   priority: int = PRIORITY_INTERACTIVE):
+    """Encola convert_task en la cola de su tipo."""
+    return convert_task.apply_async((input_path, kind, target, sha256),
+                                    queue=queue_for(kind), priority=priority, **time_limits(kind))
+
+# ====== Varias salidas de una sola entrada (decodificar una vez) ======
+# Presets que llevan su propio -vf no se pueden combinar con el filtergraph compartido
+MULTI_VIDEO_EXCLUDED = {"gif", "3gp", "3g2"}
+
+def _variant_name(base: str, t: str, variant: str) -> str:
+    return f"{base}_{variant}.{t}" if variant else f"{base}.{t}"
+
+def multi_video_cmd(input_path: str, outputs: list) -> str:
+    """Un único ffmpeg: split del vídeo decodificado y una salida por (target, altura)."""
+    n = len(outputs)
+    graph = [f"[0:v]split={n}" + "".join(f"[s{i}]" for i in range(n))]
+    for i, (_, _, height) in enumerate(outputs):
+        graph.append(f"[s{i}]scale=-2:'min({height},ih)'[o{i}]" if height else f"[s{i}]null[o{i}]")
+    cmd = f'ffmpeg -y -progress pipe:1 -nostats -i "{input_path}" -filter_complex "{";".join(graph)}"'
+    for i, (out, t, _) in enumerate(outputs):
+        cmd += f' -map "[o{i}]" -map 0:a? {VIDEO_ENC[t]} "{out}"'
+    return cmd
+
+@celery.task(bind=True)
+def convert_multi_task(self, input_path: str, kind: str, targets: list,
+                       heights: list = None, sizes: list = None):
+    """Fan-out: varios formatos y/o resoluciones (vídeo: heights; imagen: sizes) con
+    una sola decodificación; las salidas se suben en paralelo."""
+    tmpdir = tempfile.mkdtemp()
+    src = input_path
+    try:
+        input_path = local_input(src, os.path.join(tmpdir, "in"))
+        base = os.path.splitext(os.path.basename(input_path))[0]
+        ts = list(dict.fromkeys(normalize_target(t) for t in targets))
+        if not ts:
+            raise ValueError("sin formatos de salida")
+        timings = {"queue_wait": queue_wait(self.request)}
 
-        url = upload(out)
-        return {"download_url": url, "log": log}
+        t0 = metrics.begin("ffmpeg" if kind == "video" else "")
+        if kind == "video":
+            bad = [t for t in ts if t not in VIDEO_ENC or t in MULTI_VIDEO_EXCLUDED]
+            if bad:
+                raise ValueError(f"formatos no admitidos en salida múltiple: {', '.join(bad)}")
+            variants = [(int(h), f"{int(h)}p") for h in heights] if heights else [(None, "")]
+            outputs = [(os.path.join(tmpdir, _variant_name(base, t, v)), t, h)
+                       for t in ts for h, v in variants]
+            log = run(multi_video_cmd(input_path, outputs), ffmpeg_progress(self))
+
+        elif kind == "image":
+            variants = [(int(x), f"{int(x)}px") for x in sizes] if sizes else [(None, "")]
+            outputs = [(os.path.join(tmpdir, _variant_name(base, t, v)), t, x)
+                       for t in ts for x, v in variants]
+            if all(vips_engine.supports(t) for t in ts):
+                metrics.engine("vips")
+                vips_engine.convert_many(input_path, outputs)
+                log = f"libvips x{len(outputs)}"
+            else:
+                metrics.engine("imagemagick")
+                IM = _im_bin()
+                for out, t, x in outputs:
+                    if x:
+                        run(f'{IM} "{input_path}" -auto-orient -thumbnail "{x}x{x}>" "{out}"')
+                    else:
+                        convert_image(input_path, out, t)
+                log = f"ImageMagick x{len(outputs)}"
+        else:
+            raise ValueError("kind inválido (usa 'video' o 'image')")
+        metrics.end("convert", t0, kind, "multi", timings)
+
+        with metrics.stage("storage_upload", kind, "multi", timings=timings):
+            with ThreadPoolExecutor(max_workers=len(outputs)) as ex:
+                keys = list(ex.map(lambda o: put_object(o[0]), outputs))
+        result = {
+            "outputs": [{"name": os.path.basename(o[0]), "target": o[1], "variant": o[2],
+                         "download_url": presign(k), "key": k}
+                        for o, k in zip(outputs, keys)],
+            "log": log,
+        }
+        if RESULT_TIMINGS:
+            result["timings"] = timings
+        return result
     finally:
         shutil.rmtree(tmpdir, ignore_errors=True)
+        drop_input(src)
+
+def submit_multi(input_path: str, kind: str, targets: list, heights: list = None,
+                 sizes: list = None, priority: int = PRIORITY_INTERACTIVE):
+    outputs = len(targets) * max(1, len(heights or sizes or ()))
+    return convert_multi_task.apply_async((input_path, kind, targets, heights, sizes),
+                                          queue=queue_for(kind), priority=priority,
+                                          **time_limits(kind, outputs))
+
+# ====== Batch por trozos ======
+# Conversores "en proceso" aptos para agrupar muchos archivos en una sola tarea
+CHUNK_CONVERTERS = {"image": convert_image, "audio": convert_audio}
+# Tipos que además convierten varios archivos por llamada: (conversor, archivos por llamada)
+CHUNK_GROUPS = {"audio": (convert_audio_many, AUDIO_FILES_PER_FFMPEG)}
+
+def _one_by_one(convert):
+    """Adapta un conversor de un archivo a la interfaz de grupo de CHUNK_GROUPS."""
+    def convert_many(jobs: list, t: str, fast: bool = False) -> list:
+        results = []
+        for path, out in jobs:
+            try:
+                results.append(convert(path, out, t, fast))
+            except Exception as e:
+                results.append(e)
+        return results
+    return convert_many
+
+@celery.task(bind=True)
+def convert_chunk_task(self, items: list, kind: str, target: str):
+    """Convierte un trozo de batch (items: [{name, path, sha256}]) en un solo proceso:
+    conversión y subida de cada archivo (o grupo de archivos, ver CHUNK_GROUPS) en
+    paralelo en el pool de hilos.
+    Devuelve {"files": [...]} con download_url o error por archivo."""
+    t = normalize_target(target)
+    convert_many, per_call = CHUNK_GROUPS.get(kind, (_one_by_one(CHUNK_CONVERTERS[kind]), 1))
+    fast = under_load(kind, BATCH_QUEUE)
+    tmpdir = tempfile.mkdtemp()
+    publish = _publisher(self, "batch")
+    stopped = threading.Event()  # cancelada o fuera de tiempo: los hilos no siguen
+
+    def group(idx: list) -> list:
+        """Convierte y sube items[idx]; devuelve [(i, resultado)]."""
+        results, jobs = {}, []
         try:
-            os.remove(input_path)
-        except Exception:
-            pass
+            for i in idx:
+                item = items[i]
+                if stopped.is_set():
+                    return []
+                try:
+                    outdir = os.path.join(tmpdir, str(i))  # mismo nombre de objeto que convert_task
+                    os.mkdir(outdir)  # sin makedirs: no recrea tmpdir si ya se borró
+                    path = local_input(item["path"], os.path.join(outdir, "in"))
+                    sha256 = item.get("sha256") or file_sha256(path)
+                    hit = cache_lookup(sha256, kind, t)
+                    if hit:
+                        results[i] = {"name": item["name"], **hit}
+                        continue
+                    base = os.path.splitext(os.path.basename(path))[0]
+                    jobs.append((i, path, os.path.join(outdir, f"{base}.{t}"), sha256))
+                except Exception as e:
+                    results[i] = {"name": item["name"], "error": str(e)}
+            if not jobs:
+                return [(i, results[i]) for i in idx]
+
+            t0 = metrics.begin()
+            logs = convert_many([(path, out) for _, path, out, _ in jobs], t, fast)
+            # una llamada para todo el grupo: cada archivo se anota con su parte
+            secs = (time.perf_counter() - t0) / len(jobs)
+            engine = metrics.current_engine()
+            for (i, _, out, sha256), log in zip(jobs, logs):
+                if stopped.is_set():
+                    return []
+                name = items[i]["name"]
+                metrics.observe("convert", secs, kind, t, engine)
+                timings = {"convert": round(secs, 3)}
+                try:
+                    if isinstance(log, Exception):
+                        raise log
+                    with metrics.stage("storage_upload", kind, t, timings=timings):
+                        key = put_object(out)
+                    cache_store(sha256, kind, t, key)
+                    res = {"name": name, "download_url": presign(key), "key": key, "log": log}
+                    if RESULT_TIMINGS:
+                        res["timings"] = timings
+                    results[i] = res
+                except Exception as e:
+                    results[i] = {"name": name, "error": str(e)}
+            return [(i, results[i]) for i in idx]
+        finally:
+            for i in idx:
+                drop_input(items[i]["path"])
+
+    futures = {}
+    try:
+        files = [None] * len(items)
+        for i in range(0, len(items), per_call):
+            idx = list(range(i, min(i + per_call, len(items))))
+            futures[vips_engine.pool().submit(group, idx)] = idx
+        done = 0
+        for fut in as_completed(futures):
+            for i, res in fut.result():
+                files[i] = res
+                done += 1
+            publish(done=done, total=len(items), percent=round(done / len(items) * 100, 1))
+        failed = sum(1 for f in files if "error" in f)
+        return {"files": files, "done": len(files) - failed, "failed": failed}
+    finally:
+        stopped.set()
+        for fut, idx in futures.items():
+            if fut.cancel():  # aún en cola del pool: nadie más borrará sus entradas
+                for i in idx:
+                    drop_input(items[i]["path"])
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def submit_chunks(items: list, kind: str, target: str, priority: int = PRIORITY_BATCH) -> list:
+    """Agrupa items en trozos de BATCH_CHUNK_FILES y encola una tarea por trozo.
+    Devuelve [(task_id, items_del_trozo)]."""
+    out = []
+    for i in range(0, len(items), BATCH_CHUNK_FILES):
+        chunk = items[i:i + BATCH_CHUNK_FILES]
+        calls = -(-len(chunk) // CHUNK_GROUPS.get(kind, (None, 1))[1])
+        rounds = -(-calls // vips_engine.VIPS_THREADS)  # tandas del pool de hilos
+        task = convert_chunk_task.apply_async((chunk, kind, target), queue=BATCH_QUEUE,
+                                              priority=priority, **time_limits(kind, rounds))
+        out.append((task.id, chunk))
+    return out
 
 # ====== Descargas evitando HLS (m3u8) ======
+DOWNLOAD_QUALITIES = {"best", "1080p", "720p", "480p", "360p", "256k", "128k"}
 UA = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36'
-BASE_YTDLP = f'yt-dlp --no-playlist -N 4 -R 10 --retry-sleep 1 --user-agent "{UA}"'
+BASE_YTDLP = f'yt-dlp --newline --no-playlist -N 4 -R 10 --retry-sleep 1 --user-agent "{UA}"'
 
 @celery.task(bind=True)
 def download_task(self, url: str, kind: str, quality: str):
@@ -276,14 +1358,145 @@ def download_task(self, url: str, kind: str, quality: str):
         else:
             raise ValueError("kind inválido (usa 'video' o 'audio')")
 
-        log = run(cmd)
+        timings = {"queue_wait": queue_wait(self.request)}
+        with metrics.stage("download", kind, quality, "yt-dlp", timings):
+            log = run(cmd, ytdlp_progress(self))
 
         files = [os.path.join(tmpdir, f) for f in os.listdir(tmpdir)]
         if not files:
             raise RuntimeError("No se generó ningún archivo")
 
-        url_out = upload(files[0])
-        return {"download_url": url_out, "log": log}
+        with metrics.stage("storage_upload", kind, quality, timings=timings):
+            key = put_object(files[0])
+        _cache_put(_fetch_key(url, kind, quality), key)
+        result = {"download_url": presign(key), "key": key, "log": log}
+        if RESULT_TIMINGS:
+            result["timings"] = timings
+        return result
 
     finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
\ No newline at end of file
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        _fetch_release(url, kind, quality, self.request.id)
+
+# ====== Mantenimiento: janitor periódico y control de espacio en disco ======
+def _newest_mtime(path: str) -> float:
+    """mtime más reciente de path y todo lo que contiene."""
+    newest = os.lstat(path).st_mtime
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                newest = max(newest, os.lstat(os.path.join(root, name)).st_mtime)
+            except OSError:
+                pass
+    return newest
+
+def clean_shared(max_age: int) -> int:
+    """Borra de SHARED_DIR lo que nadie toca desde hace max_age segundos
+    (y los jobdirs vacíos tras JANITOR_GRACE_SECS). Devuelve las entradas borradas."""
+    now = time.time()
+    removed = 0
+    for entry in os.scandir(SHARED_DIR):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                empty = not os.listdir(entry.path)
+                age = now - (entry.stat(follow_symlinks=False).st_mtime if empty else _newest_mtime(entry.path))
+                if age < (JANITOR_GRACE_SECS if empty else max_age):
+                    continue
+                shutil.rmtree(entry.path)
+            else:
+                if now - entry.stat(follow_symlinks=False).st_mtime < max_age:
+                    continue
+                os.remove(entry.path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+@celery.task(bind=True)
+def janitor_task(self):
+    """Recupera espacio: entradas huérfanas de /shared, resultados e inputs caducados
+    (sus URLs firmadas y la caché duran URL_EXPIRES_SECS) y multipart abandonados."""
+    if not rds.set("mcd:janitor", self.request.id or "1", nx=True, ex=max(1, JANITOR_INTERVAL_SECS // 2)):
+        return {"skipped": True}
+    max_age = URL_EXPIRES_SECS + JANITOR_GRACE_SECS
+    report = {
+        "shared": clean_shared(max_age),
+        "jobs": storage.delete_older_than(BUCKET, max_age),
+        "inputs": storage.delete_older_than(INPUT_BUCKET, max_age),
+        "multipart": sum(storage.abort_stale_uploads(b, max_age) for b in (BUCKET, INPUT_BUCKET)),
+    }
+    logger.info("janitor: %s", report)
+    return report
+
+def disk_free_mb(path: str) -> float:
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize / (1024 * 1024)
+
+def low_disk(min_free_mb: float = MIN_FREE_MB) -> list:
+    """Rutas de trabajo (/shared y tmp) con menos de min_free_mb libres."""
+    paths = {SHARED_DIR, tempfile.gettempdir()}
+    return [p for p in sorted(paths) if os.path.isdir(p) and disk_free_mb(p) < min_free_mb]
+
+@signals.worker_ready.connect
+def _start_disk_guard(sender=None, **kwargs):
+    """Con poco disco el worker deja de consumir sus colas (las tareas en curso
+    terminan) y vuelve cuando hay un 25 % de margen sobre MIN_FREE_MB."""
+    if not MIN_FREE_MB or sender is None:
+        return
+    hostname = sender.hostname
+    qs = sender.app.amqp.queues
+    queues = [q for q in (qs.consume_from or qs) if q != MAINTENANCE_QUEUE]
+
+    def guard():
+        paused = False
+        while True:
+            try:
+                low = low_disk(MIN_FREE_MB * 1.25 if paused else MIN_FREE_MB)
+                if low and not paused:
+                    logger.warning("poco espacio en %s: %s deja de consumir %s", low, hostname, queues)
+                    for q in queues:
+                        celery.control.cancel_consumer(q, destination=[hostname])
+                    paused = True
+                elif not low and paused:
+                    logger.warning("espacio recuperado: %s vuelve a consumir %s", hostname, queues)
+                    for q in queues:
+                        celery.control.add_consumer(q, destination=[hostname])
+                    paused = False
+            except Exception:
+                logger.exception("disk guard")
+            time.sleep(DISK_CHECK_SECS)
+
+    threading.Thread(target=guard, daemon=True, name="disk-guard").start()
+
+# Destinos de cada tipo, sacados de las tablas de arriba (bench.py los recorre todos)
+TARGETS_BY_KIND = {
+    "image": [*vips_engine.SAVE_OPTS, *sorted(IMAGE_IM_TARGETS)],
+    "video": [*VIDEO_ENC, "gif"],
+    "audio": [*AUDIO_ENC],
+    "mesh":  [*ASSIMP_FORMATS, *CAD_TARGETS],
+}
+
+def available_targets() -> dict:
+    """TARGETS_BY_KIND sin los destinos CAD cuya herramienta no está instalada
+    (api y workers salen de la misma imagen, con o sin WITH_CAD)."""
+    return {kind: [t for t in ts if t not in CAD_TARGETS or cad_pool.available(CAD_TARGETS[t])]
+            for kind, ts in TARGETS_BY_KIND.items()}
+
+# Etiquetas de las métricas: solo tipos y formatos conocidos (o calidades de descarga)
+metrics.allow_labels(
+    QUEUE_BY_KIND,
+    {*(t for ts in TARGETS_BY_KIND.values() for t in ts), "multi", *DOWNLOAD_QUALITIES},
+)
+
+@signals.worker_init.connect
+def _metrics_reset(**kwargs):
+    metrics.reset_multiproc_dir()
+
+@signals.worker_ready.connect
+def _metrics_serve(**kwargs):
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+
+@signals.worker_process_shutdown.connect
+def _metrics_process_dead(pid=None, **kwargs):
+    metrics.process_dead(pid or os.getpid())